@@ -9,6 +9,8 @@
   foreign key (parent_id) references disk_tree(id) on delete cascade
 );
 
+create index disk_tree_full_route_idx on disk_tree (full_route text_pattern_ops);
+
 create table node_history (
   id varchar,
   content jsonb,
@@ -0,0 +1,61 @@
+import random
+
+MAX_FILE_SIZE = 1 << 20
+# Размер корня - сумма всех файлов дерева, и он, как и размер любой папки, должен влезать в integer столбца size
+MAX_TREE_SIZE = (1 << 31) - 1
+
+SIZE_DISTRIBUTIONS = {
+    'uniform': lambda rng: rng.randint(1, MAX_FILE_SIZE),
+    'lognormal': lambda rng: rng.lognormvariate(8, 1.5),
+    'pareto': lambda rng: 256 * rng.paretovariate(1.2),
+}
+
+
+def file_size(rng, distribution) -> int:
+    return max(1, min(MAX_FILE_SIZE, int(SIZE_DISTRIBUTIONS[distribution](rng))))
+
+
+def generate_tree(depth, fanout, files_per_folder, sizes='lognormal', seed=0, prefix='n') -> dict:
+    """
+    Синтетическое дерево: корневая папка, у каждой папки выше depth - fanout подпапок,
+    в каждой папке files_per_folder файлов с размерами из распределения sizes.
+    Размеры урезаются так, чтобы сумма всех файлов не превышала MAX_TREE_SIZE.
+    Возвращает элементы SystemItemImport в порядке обхода в ширину (родители раньше детей),
+    а также списки папок и файлов по уровням для выбора целей запросов.
+    """
+
+    files_left = files_per_folder * sum(fanout ** level for level in range(depth + 1))
+    if files_left > MAX_TREE_SIZE:
+        raise ValueError(f"{files_left} files can't fit into a tree of at most {MAX_TREE_SIZE} bytes")
+    rng = random.Random(seed)
+    # Каждому еще не созданному файлу оставляется хотя бы байт, так что сумма не выходит за MAX_TREE_SIZE
+    budget = MAX_TREE_SIZE
+    items, folders, files = [], [], []
+    level = [f'{prefix}-root']
+    items.append({'id': level[0], 'type': 'FOLDER', 'url': None, 'parentId': None, 'size': None})
+    for current_depth in range(depth + 1):
+        folders.append(level)
+        files.append([])
+        next_level = []
+        for folder_id in level:
+            for index in range(files_per_folder):
+                file_id = f'{folder_id}.f{index}'
+                files[-1].append(file_id)
+                files_left -= 1
+                size = min(file_size(rng, sizes), budget - files_left)
+                budget -= size
+                items.append({'id': file_id, 'type': 'FILE', 'url': f'/{file_id}', 'parentId': folder_id,
+                              'size': size})
+            if current_depth < depth:
+                for index in range(fanout):
+                    child_id = f'{folder_id}.d{index}'
+                    next_level.append(child_id)
+                    items.append({'id': child_id, 'type': 'FOLDER', 'url': None, 'parentId': folder_id,
+                                  'size': None})
+        level = next_level
+    return {'items': items, 'folders': folders, 'files': files}
+
+
+def batches(items, batch_size):
+    for start in range(0, len(items), batch_size):
+        yield items[start:start + batch_size]
@@ -0,0 +1,361 @@
+"""
+Нагрузочный прогон сервиса.
+
+    python -m bench.runner synthetic --database-url memory:// --depth 4 --fanout 4 --files 8
+    python -m bench.runner replay traffic.jsonl --database-url postgresql://... --speed 1
+
+Без --target приложение поднимается в этом же процессе поверх database_url (memory://, postgresql://,
+postgresql+asyncpg://), и в отчете есть число вызовов хранилища на запрос. С --target http://host:port
+запросы идут по сети в уже запущенный сервис. Трафик для replay записывает сам сервис,
+если задать ему переменную окружения record_traffic=path.
+
+Отчет, сохраненный через --output, служит базой для следующих прогонов: с --baseline report.json
+прогон завершается с кодом 1, если p95 сценария вырос больше чем на --max-regression
+или запрос стал делать больше вызовов хранилища.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from urllib.parse import parse_qsl, urlencode
+
+import httpx
+
+from bench.generator import SIZE_DISTRIBUTIONS, batches, file_size, generate_tree
+
+REPOSITORY_CALLS = 'repository_call_duration_seconds'
+# Шаблоны путей, по которым группируются запросы при воспроизведении
+ROUTES = [(template, re.compile('^' + re.sub(r'\{\w+\}', '[^/]+', template) + '$')) for template in
+          ('/imports', '/imports/stream', '/nodes/{id}', '/node/{id}/history', '/delete/{id}', '/updates')]
+# Параметры и поля тела с датами, которые сдвигаются при воспроизведении
+DATE_PARAMS = ('date', 'date_start', 'date_end', 'updateDate')
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def format_date(value) -> str:
+    return value.astimezone(timezone.utc).isoformat().replace('+00:00', 'Z')
+
+
+def parse_date(value) -> datetime:
+    return datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+
+class Scenario:
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.errors = 0
+        self.wall = 0.0
+        self.calls = None
+
+    def report(self) -> dict:
+        count = len(self.latencies)
+        return {'scenario': self.name, 'requests': count, 'errors': self.errors,
+                'rps': round(count / self.wall, 1) if self.wall else 0.0,
+                'p50_ms': round(percentile(self.latencies, 0.50) * 1000, 2),
+                'p95_ms': round(percentile(self.latencies, 0.95) * 1000, 2),
+                'p99_ms': round(percentile(self.latencies, 0.99) * 1000, 2),
+                'calls_per_request': round(self.calls / count, 2) if self.calls is not None and count else None}
+
+
+class Bench:
+    """HTTP-клиент прогона: в процессе через ASGITransport или по сети, с замером каждого запроса"""
+
+    def __init__(self, target, concurrency):
+        self._target = target
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._app = None
+        self.client = None
+
+    async def __aenter__(self):
+        if self._target:
+            self.client = httpx.AsyncClient(base_url=self._target, timeout=None)
+        else:
+            # main читает окружение при импорте, поэтому импорт откладывается до разбора аргументов
+            import main
+            self._app = main.app
+            for handler in self._app.router.on_startup:
+                await handler()
+            transport = httpx.ASGITransport(app=self._app, raise_app_exceptions=False)
+            self.client = httpx.AsyncClient(transport=transport, base_url='http://bench', timeout=None)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.client.aclose()
+        if self._app is not None:
+            for handler in self._app.router.on_shutdown:
+                await handler()
+
+    async def repository_calls(self):
+        if self._app is None:
+            return None
+        from routes.router import database, metrics
+        await database.flush_history()
+        # Сам замер вызывает flush_history, поэтому она не учитывается
+        return sum(count for (name, labels), (count, _) in metrics.snapshot().items()
+                   if name == REPOSITORY_CALLS and labels != (('method', 'flush_history'),))
+
+    async def request(self, scenario, method, url, **kwargs) -> httpx.Response:
+        async with self._semaphore:
+            start = time.perf_counter()
+            response = await self.client.request(method, url, **kwargs)
+            scenario.latencies.append(time.perf_counter() - start)
+        if response.status_code >= 400:
+            scenario.errors += 1
+        return response
+
+    async def run(self, name, requests, sequential=False) -> Scenario:
+        """
+        requests - список функций scenario -> корутина. Выполняются параллельно в пределах concurrency,
+        либо по одной в заданном порядке при sequential.
+        """
+
+        scenario = Scenario(name)
+        calls_before = await self.repository_calls()
+        start = time.perf_counter()
+        if sequential:
+            for request in requests:
+                await request(scenario)
+        else:
+            await asyncio.gather(*(request(scenario) for request in requests))
+        scenario.wall = time.perf_counter() - start
+        calls_after = await self.repository_calls()
+        if calls_before is not None:
+            scenario.calls = calls_after - calls_before
+        return scenario
+
+
+async def synthetic(args) -> list:
+    rng = random.Random(args.seed)
+    prefix = args.prefix or f'bench{os.urandom(4).hex()}'
+    tree = generate_tree(args.depth, args.fanout, args.files, args.sizes, args.seed, prefix)
+    folders = [folder for level in tree['folders'] for folder in level]
+    files = [file for level in tree['files'] for file in level]
+    deepest_files = tree['files'][-1] or files
+    # Импорт разрешен только не в прошлом
+    start_date = datetime.now(timezone.utc).replace(microsecond=0) + timedelta(days=1)
+    dates = iter(start_date + timedelta(seconds=step) for step in range(1 << 30))
+    results = []
+
+    async with Bench(args.target, args.concurrency) as bench:
+        def post_batch(batch, date):
+            return lambda scenario: bench.request(scenario, 'POST', '/imports',
+                                                  json={'items': batch, 'updateDate': date})
+        # Импорт последовательный: родители каждой пачки уже импортированы предыдущими
+        results.append(await bench.run('imports', [post_batch(batch, format_date(next(dates)))
+                                                   for batch in batches(tree['items'], args.batch_size)],
+                                       sequential=True))
+
+        def get_node(node_id):
+            return lambda scenario: bench.request(scenario, 'GET', f'/nodes/{node_id}')
+        results.append(await bench.run('nodes', [get_node(rng.choice(folders)) for _ in range(args.requests)]))
+
+        def reimport(file_id, date):
+            parent_id = file_id.rsplit('.', 1)[0]
+            item = {'id': file_id, 'type': 'FILE', 'url': f'/{file_id}', 'parentId': parent_id,
+                    'size': file_size(rng, args.sizes)}
+            return lambda scenario: bench.request(scenario, 'POST', '/imports',
+                                                  json={'items': [item], 'updateDate': date})
+        results.append(await bench.run('reimport_deep_file', [reimport(rng.choice(deepest_files),
+                                                                       format_date(next(dates)))
+                                                              for _ in range(args.requests)]))
+
+        last_date = format_date(next(dates))
+
+        def get_updates():
+            return lambda scenario: bench.request(scenario, 'GET', '/updates', params={'date': last_date})
+        results.append(await bench.run('updates', [get_updates() for _ in range(args.requests)]))
+
+        history_range = {'date_start': format_date(start_date), 'date_end': last_date}
+
+        def get_history(node_id):
+            return lambda scenario: bench.request(scenario, 'GET', f'/node/{node_id}/history',
+                                                  params=history_range)
+        results.append(await bench.run('history', [get_history(rng.choice(folders + files))
+                                                   for _ in range(args.requests)]))
+
+        # Удаляются разные непересекающиеся папки предпоследнего уровня вместе с поддеревьями
+        candidates = tree['folders'][-2] if len(tree['folders']) > 1 else tree['folders'][-1]
+        targets = rng.sample(candidates, min(args.deletes, len(candidates)))
+
+        def delete(node_id, date):
+            return lambda scenario: bench.request(scenario, 'DELETE', f'/delete/{node_id}', params={'date': date})
+        results.append(await bench.run('delete', [delete(node_id, format_date(next(dates))) for node_id in targets]))
+    return [scenario.report() for scenario in results]
+
+
+def route_of(path) -> str:
+    for template, pattern in ROUTES:
+        if pattern.match(path):
+            return template
+    return path
+
+
+def shift_dates(record, delta) -> dict:
+    query = [(name, format_date(parse_date(value) + delta) if name in DATE_PARAMS else value)
+             for name, value in parse_qsl(record['query'], keep_blank_values=True)]
+    body = record['body']
+    if body and body.lstrip().startswith('{'):
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            payload = None
+        if isinstance(payload, dict) and isinstance(payload.get('updateDate'), str):
+            payload['updateDate'] = format_date(parse_date(payload['updateDate']) + delta)
+            body = json.dumps(payload, ensure_ascii=False)
+    return dict(record, query=urlencode(query), body=body)
+
+
+def earliest_date(records):
+    dates = []
+    for record in records:
+        dates += [parse_date(value) for name, value in parse_qsl(record['query']) if name in DATE_PARAMS]
+        if record['body'] and '"updateDate"' in record['body']:
+            try:
+                dates.append(parse_date(json.loads(record['body'])['updateDate']))
+            except (ValueError, KeyError, TypeError):
+                pass
+    return min(dates) if dates else None
+
+
+async def replay(args) -> list:
+    with open(args.path, encoding='utf-8') as traffic:
+        records = [json.loads(line) for line in traffic if line.strip()]
+    if args.shift_dates:
+        # Сдвиг переносит записанные даты в будущее, иначе импорты отклоняются как даты в прошлом
+        earliest = earliest_date(records)
+        if earliest is not None:
+            delta = datetime.now(timezone.utc) + timedelta(days=1) - earliest
+            records = [shift_dates(record, delta) for record in records]
+
+    scenarios = {}
+    total = Scenario('total')
+    async with Bench(args.target, args.concurrency) as bench:
+        start = time.perf_counter()
+        for record in records:
+            if args.speed:
+                delay = record['t'] / args.speed - (time.perf_counter() - start)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            name = f"{record['method']} {route_of(record['path'])}"
+            scenario = scenarios.setdefault(name, Scenario(name))
+            body = record['body'].encode() if record['body'] is not None else None
+            content_type = 'application/json' if body and body.lstrip().startswith(b'{') else 'application/x-ndjson'
+            url = record['path'] + ('?' + record['query'] if record['query'] else '')
+            # Воспроизведение последовательное, поэтому вызовы хранилища считаются по каждому запросу
+            calls_before = await bench.repository_calls()
+            await bench.request(scenario, record['method'], url, content=body,
+                                headers={'content-type': content_type} if body else None)
+            calls_after = await bench.repository_calls()
+            if calls_before is not None:
+                scenario.calls = (scenario.calls or 0) + calls_after - calls_before
+        total.wall = time.perf_counter() - start
+    for scenario in scenarios.values():
+        # Пропускная способность маршрута - по его собственному времени, без пауз и других запросов
+        scenario.wall = sum(scenario.latencies)
+        total.latencies += scenario.latencies
+        total.errors += scenario.errors
+        if scenario.calls is not None:
+            total.calls = (total.calls or 0) + scenario.calls
+    return [scenario.report() for scenario in list(scenarios.values()) + [total]]
+
+
+def print_table(rows) -> None:
+    columns = ['scenario', 'requests', 'errors', 'rps', 'p50_ms', 'p95_ms', 'p99_ms', 'calls_per_request']
+    widths = [max(len(column), *(len(str(row[column])) for row in rows)) for column in columns]
+    print('  '.join(column.ljust(width) for column, width in zip(columns, widths)))
+    for row in rows:
+        print('  '.join(str(row[column]).ljust(width) for column, width in zip(columns, widths)))
+
+
+def find_regressions(rows, baseline, max_regression, min_delta_ms) -> list:
+    """
+    Сравнивает отчет с базовым по одноименным сценариям. Рост p95 меньше min_delta_ms не считается:
+    на коротких запросах он тонет в шуме. Число вызовов хранилища не шумит и сравнивается точно.
+    """
+
+    base_rows = {row['scenario']: row for row in baseline}
+    regressions = []
+    for row in rows:
+        base = base_rows.get(row['scenario'])
+        if base is None:
+            continue
+        allowed = max(base['p95_ms'] * (1 + max_regression), base['p95_ms'] + min_delta_ms)
+        if row['p95_ms'] > allowed:
+            regressions.append(f"{row['scenario']}: p95 {row['p95_ms']} ms, baseline {base['p95_ms']} ms")
+        calls, base_calls = row.get('calls_per_request'), base.get('calls_per_request')
+        if calls is not None and base_calls is not None and calls > base_calls:
+            regressions.append(f"{row['scenario']}: {calls} repository calls per request, baseline {base_calls}")
+    return regressions
+
+
+def parse_args(argv):
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--target', help='адрес запущенного сервиса; без него приложение поднимается в процессе')
+    common.add_argument('--database-url', default='memory://', help='хранилище для прогона в процессе')
+    common.add_argument('--cache-bytes', type=int, default=0, help='размер кэша поддеревьев в процессе')
+    common.add_argument('--log-file', default=os.devnull, help='лог приложения в процессе')
+    common.add_argument('--concurrency', type=int, default=8)
+    common.add_argument('--output', help='сохранить отчет в JSON')
+    common.add_argument('--baseline', help='отчет прошлого прогона (JSON из --output) для сравнения')
+    common.add_argument('--max-regression', type=float, default=0.25,
+                        help='допустимый относительный рост p95 по сравнению с --baseline')
+    common.add_argument('--min-regression-ms', type=float, default=1.0,
+                        help='рост p95 меньше этого числа миллисекунд не считается регрессией')
+
+    parser = argparse.ArgumentParser(prog='python -m bench.runner')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    synthetic_parser = commands.add_parser('synthetic', parents=[common], help='прогон на синтетическом дереве')
+    synthetic_parser.add_argument('--depth', type=int, default=4)
+    synthetic_parser.add_argument('--fanout', type=int, default=4)
+    synthetic_parser.add_argument('--files', type=int, default=8, help='файлов в каждой папке')
+    synthetic_parser.add_argument('--sizes', choices=sorted(SIZE_DISTRIBUTIONS), default='lognormal')
+    synthetic_parser.add_argument('--batch-size', type=int, default=1000, help='элементов в одном /imports')
+    synthetic_parser.add_argument('--requests', type=int, default=500, help='запросов в каждом сценарии чтения')
+    synthetic_parser.add_argument('--deletes', type=int, default=4)
+    synthetic_parser.add_argument('--seed', type=int, default=0)
+    synthetic_parser.add_argument('--prefix', help='префикс id; по умолчанию случайный, чтобы прогоны не пересекались')
+
+    replay_parser = commands.add_parser('replay', parents=[common], help='воспроизведение записанного трафика')
+    replay_parser.add_argument('path')
+    replay_parser.add_argument('--speed', type=float, default=0, help='ускорение относительно записи; 0 - без пауз')
+    replay_parser.add_argument('--no-shift-dates', dest='shift_dates', action='store_false',
+                               help='не сдвигать даты запросов к текущему времени')
+    return parser.parse_args(argv)
+
+
+def main(argv) -> int:
+    args = parse_args(argv)
+    if not args.target:
+        os.environ['database_url'] = args.database_url
+        os.environ['subtree_cache_bytes'] = str(args.cache_bytes)
+        os.environ.setdefault('log_file', args.log_file)
+    rows = asyncio.run(synthetic(args) if args.command == 'synthetic' else replay(args))
+    print_table(rows)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output:
+            json.dump(rows, output, indent=2)
+    failed = any(row['errors'] for row in rows)
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as baseline:
+            regressions = find_regressions(rows, json.load(baseline), args.max_regression, args.min_regression_ms)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        failed = failed or bool(regressions)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
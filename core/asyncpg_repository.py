@@ -0,0 +1,122 @@
+import re
+from collections import namedtuple
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from functools import lru_cache
+
+import asyncpg
+
+from core.nodes_repository import NodesRepository
+
+# Строковые литералы пропускаются целиком, чтобы не принять двоеточие внутри них за параметр
+PARAMETER = re.compile(r"'(?:[^']|'')*'|(?<!:):([A-Za-z_]\w*)")
+# Сколько строк курсор забирает с сервера за один раз при потоковом чтении
+CURSOR_PREFETCH = 1000
+
+
+@lru_cache(maxsize=256)
+def compile_query(query) -> tuple:
+    """Переводит именованные параметры :name в позиционные $n. Возвращает текст и порядок имен"""
+
+    names = []
+
+    def replace(match):
+        name = match.group(1)
+        if name is None:
+            return match.group(0)
+        if name not in names:
+            names.append(name)
+        return f'${names.index(name) + 1}'
+
+    return PARAMETER.sub(replace, query), tuple(names)
+
+
+@lru_cache(maxsize=256)
+def row_type(columns):
+    return namedtuple('Row', columns, rename=True)
+
+
+def decode_rows(records) -> list:
+    if not records:
+        return []
+    row = row_type(tuple(records[0].keys()))
+    return [row._make(record) for record in records]
+
+
+class AsyncpgDatabase:
+    """
+    Пул asyncpg с тем же интерфейсом, что у databases.Database, которым пользуется NodesRepository.
+    Запросы уходят в драйвер без компиляции SQLAlchemy; подготовленные выражения asyncpg кэширует
+    на каждом соединении (statement_cache_size), строки отдаются именованными кортежами.
+    Внутри transaction() все запросы задачи идут через одно соединение.
+    """
+
+    def __init__(self, connection_string, **pool_options):
+        self._connection_string = connection_string
+        self._pool_options = pool_options
+        self._pool = None
+        self._current = ContextVar('asyncpg_connection', default=None)
+
+    async def connect(self):
+        self._pool = await asyncpg.create_pool(self._connection_string, **self._pool_options)
+
+    async def disconnect(self):
+        await self._pool.close()
+        self._pool = None
+
+    @asynccontextmanager
+    async def _acquire(self):
+        connection = self._current.get()
+        if connection is not None:
+            yield connection
+            return
+        async with self._pool.acquire() as connection:
+            yield connection
+
+    @asynccontextmanager
+    async def transaction(self):
+        async with self._acquire() as connection:
+            token = self._current.set(connection)
+            try:
+                async with connection.transaction():
+                    yield
+            finally:
+                self._current.reset(token)
+
+    async def execute(self, query, values=None):
+        query, args = self._bind(query, values)
+        async with self._acquire() as connection:
+            return await connection.fetchval(query, *args)
+
+    async def fetch_one(self, query, values=None):
+        query, args = self._bind(query, values)
+        async with self._acquire() as connection:
+            record = await connection.fetchrow(query, *args)
+        return decode_rows([record])[0] if record is not None else None
+
+    async def fetch_all(self, query, values=None):
+        query, args = self._bind(query, values)
+        async with self._acquire() as connection:
+            return decode_rows(await connection.fetch(query, *args))
+
+    async def iterate(self, query, values=None):
+        query, args = self._bind(query, values)
+        async with self._acquire() as connection:
+            # Курсоры asyncpg работают только внутри транзакции
+            async with connection.transaction():
+                row = None
+                async for record in connection.cursor(query, *args, prefetch=CURSOR_PREFETCH):
+                    if row is None:
+                        row = row_type(tuple(record.keys()))
+                    yield row._make(record)
+
+    @staticmethod
+    def _bind(query, values):
+        query, names = compile_query(query)
+        return query, [values[name] for name in names]
+
+
+class AsyncpgRepository(NodesRepository):
+    """Те же запросы, что у NodesRepository, но напрямую через asyncpg, без databases и SQLAlchemy"""
+
+    database_class = AsyncpgDatabase
@@ -0,0 +1,83 @@
+from collections import OrderedDict
+
+# Примерные накладные расходы на одну запись помимо самих данных
+ENTRY_OVERHEAD = 128
+
+
+class SubtreeCache:
+    """
+    LRU-кэш сериализованных поддеревьев GET /nodes/{id} с ограничением по памяти.
+    Записи сбрасываются только для измененных узлов и их предков.
+    """
+
+    def __init__(self, max_bytes):
+        self._max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def begin(self) -> int:
+        """Запоминает поколение перед чтением из базы, чтобы не положить в кэш устаревшее дерево"""
+
+        return self._generation
+
+    def get(self, node_id):
+        """Возвращает пару (payload, headers) или None"""
+
+        entry = self._entries.get(node_id)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(node_id)
+        self.hits += 1
+        return entry[0], entry[1]
+
+    def put(self, node_id, route, payload, generation, headers=None) -> None:
+        if generation != self._generation:
+            return
+        entry_size = len(payload) + len(route or '') + ENTRY_OVERHEAD
+        if entry_size > self._max_bytes:
+            return
+        self._remove(node_id)
+        self._entries[node_id] = (payload, headers or {}, route, entry_size)
+        self._bytes += entry_size
+        while self._bytes > self._max_bytes:
+            _, (_, _, _, evicted_size) = self._entries.popitem(last=False)
+            self._bytes -= evicted_size
+            self.evictions += 1
+
+    def invalidate(self, ids=(), routes=()) -> None:
+        """Сбрасывает записи по id, а также все поддеревья, лежащие под переданными путями"""
+
+        self._generation += 1
+        for node_id in ids:
+            if self._remove(node_id):
+                self.invalidations += 1
+        prefixes = tuple(f'{route}/' for route in routes if route)
+        if prefixes:
+            for node_id, (_, _, route, _) in list(self._entries.items()):
+                if route and (f'{route}/'.startswith(prefixes)):
+                    self._remove(node_id)
+                    self.invalidations += 1
+
+    def clear(self) -> None:
+        self._generation += 1
+        self.invalidations += len(self._entries)
+        self._entries.clear()
+        self._bytes = 0
+
+    def stats(self) -> dict:
+        return {'entries': len(self._entries), 'bytes': self._bytes, 'max_bytes': self._max_bytes,
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'invalidations': self.invalidations}
+
+    def _remove(self, node_id) -> bool:
+        entry = self._entries.pop(node_id, None)
+        if entry is None:
+            return False
+        self._bytes -= entry[3]
+        return True
@@ -0,0 +1,48 @@
+from core.asyncpg_repository import AsyncpgRepository
+from core.memory_repository import MemoryRepository
+from core.nodes_repository import NodesRepository
+
+MEMORY_SCHEME = 'memory://'
+ASYNCPG_SCHEME = 'postgresql+asyncpg://'
+# Переменные окружения с настройками пула соединений Postgres и их параметры в asyncpg.create_pool
+POOL_OPTIONS = {
+    'db_pool_min_size': ('min_size', int),
+    'db_pool_max_size': ('max_size', int),
+    'db_statement_cache_size': ('statement_cache_size', int),
+    'db_command_timeout': ('command_timeout', float),
+}
+
+
+def is_memory_url(connection_string) -> bool:
+    return connection_string.startswith(MEMORY_SCHEME)
+
+
+def postgres_dsn(connection_string) -> str:
+    """Адрес Postgres в виде, который понимает asyncpg"""
+
+    if connection_string.startswith(ASYNCPG_SCHEME):
+        return 'postgresql://' + connection_string[len(ASYNCPG_SCHEME):]
+    return connection_string
+
+
+def pool_options(environ) -> dict:
+    """Настройки пула из окружения; незаданные остаются по умолчанию asyncpg"""
+
+    options = {}
+    for variable, (option, convert) in POOL_OPTIONS.items():
+        if environ.get(variable):
+            options[option] = convert(environ[variable])
+    return options
+
+
+def create_repository(connection_string, **pool_options):
+    """
+    Выбирает движок по database_url:
+    memory:// - дерево в памяти, memory:///path/to/file - в памяти с сохранением в файл,
+    postgresql+asyncpg:// - Postgres напрямую через asyncpg, иначе - Postgres через databases.
+    """
+    if is_memory_url(connection_string):
+        return MemoryRepository(connection_string[len(MEMORY_SCHEME):] or None)
+    if connection_string.startswith(ASYNCPG_SCHEME):
+        return AsyncpgRepository(postgres_dsn(connection_string), **pool_options)
+    return NodesRepository(connection_string, **pool_options)
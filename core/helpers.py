@@ -1,27 +1,111 @@
-from datetime import datetime, date
-
-
-async def update_parent(database, values, adding=True) -> None:
-    parent_node = await database.read_node({'id': values['parent_id']})
-    if parent_node:
-        while parent_node:
-            parent_size = parent_node.size if parent_node.size else 0
-            child_size = values['size'] if values['size'] else 0
-            if adding:
-                parent_size += child_size
-            else:
-                parent_size -= child_size
-            await database.update_node({'id': parent_node.id, 'date': values['date'], 'size': parent_size,
-                                        'parent_id': parent_node.parent_id})
-            if parent_node.parent_id:
-                parent_node = await database.read_node({'id': parent_node.parent_id})
-            else:
-                parent_node = None
-
-
-def json_serial(obj):
-    """JSON serializer for objects not serializable by default json code"""
-
-    if isinstance(obj, (datetime, date)):
-        return obj.isoformat()
-    raise TypeError("Type %s not serializable" % type(obj))
+from base64 import b64decode, urlsafe_b64encode
+from binascii import Error as BinasciiError
+from datetime import datetime, timezone
+from email.utils import format_datetime
+from fastapi.exceptions import RequestValidationError
+from hashlib import sha1
+from models.models import SystemItem, SystemItemType
+
+
+def add_delta(deltas, parent_id, size) -> None:
+    """Копит изменение размера непосредственного родителя в рамках пачки"""
+
+    if parent_id is not None:
+        deltas[parent_id] = deltas.get(parent_id, 0) + (size if size else 0)
+
+
+async def update_parents(database, deltas, date) -> list:
+    """
+    Применяет накопленные изменения размеров ко всем предкам одним запросом.
+    Возвращает id всех затронутых предков.
+    """
+
+    if not deltas:
+        return []
+    return await database.update_ancestors({'deltas': deltas, 'date': date})
+
+
+def build_tree(root, rows, depth=None) -> SystemItem:
+    """
+    Собирает дерево SystemItem из корня и плоского списка его потомков за O(n).
+    При заданной depth строки несут свою глубину в поле depth, и папки на глубине depth
+    остаются с children = null: их содержимое не загружалось, а size у них и так полный.
+    """
+
+    def to_item(node, level):
+        expanded = node.type == SystemItemType.FOLDER.value and (depth is None or level < depth)
+        return SystemItem(id=node.id, type=node.type, url=node.url, size=node.size, date=node.date,
+                          parentId=node.parent_id, children=[] if expanded else None)
+
+    items = {root.id: to_item(root, 0)}
+    for row in rows:
+        items[row.id] = to_item(row, row.depth if depth is not None else None)
+    for row in rows:
+        parent = items.get(row.parent_id)
+        if parent is not None and parent.children is not None:
+            parent.children.append(items[row.id])
+    return items[root.id]
+
+
+def build_snapshot(node_id, rows) -> SystemItem:
+    """Дерево среза на прошлый момент из состояний узла и его потомков"""
+
+    root = next(row for row in rows if row.id == node_id)
+    return build_tree(root, [row for row in rows if row is not root])
+
+
+def node_validators(node) -> dict:
+    """
+    ETag и Last-Modified поддерева. Любое изменение внутри папки обновляет date
+    и size всех её предков, поэтому id, date и size служат версией всего поддерева.
+    """
+
+    version = f'{node.id}|{node.date.isoformat()}|{node.size}'
+    return {'ETag': f'W/"{sha1(version.encode()).hexdigest()}"',
+            'Last-Modified': format_datetime(node.date.astimezone(timezone.utc), usegmt=True)}
+
+
+def is_not_modified(headers, validators) -> bool:
+    """
+    Проверка условного запроса только по If-None-Match. If-Modified-Since не учитывается: Last-Modified
+    точен до секунды, а date узла может уменьшиться при удалении с более ранней датой
+    """
+
+    if_none_match = headers.get('if-none-match')
+    if if_none_match is None:
+        return False
+    etag = validators['ETag'].removeprefix('W/')
+    tags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+    return '*' in tags or etag in tags
+
+
+def encode_cursor(date, node_id) -> str:
+    """Непрозрачный курсор постраничной выдачи: ключ (date, id) последнего отданного элемента"""
+
+    return urlsafe_b64encode(f'{date.isoformat()}|{node_id}'.encode()).decode()
+
+
+def decode_cursor(cursor) -> tuple:
+    try:
+        date, node_id = _decode_base64(cursor).split('|', 1)
+        return datetime.fromisoformat(date), node_id
+    except (BinasciiError, UnicodeError, ValueError):
+        raise RequestValidationError(f"Invalid cursor {cursor}")
+
+
+def encode_id_cursor(node_id) -> str:
+    """Курсор страницы детей папки: id последнего отданного ребенка"""
+
+    return urlsafe_b64encode(node_id.encode()).decode()
+
+
+def decode_id_cursor(cursor) -> str:
+    try:
+        return _decode_base64(cursor)
+    except (BinasciiError, UnicodeError, ValueError):
+        raise RequestValidationError(f"Invalid cursor {cursor}")
+
+
+def _decode_base64(cursor) -> str:
+    # validate=True не дает молча выбросить посторонние символы и принять мусор за пустой курсор
+    return b64decode(cursor.encode(), altchars=b'-_', validate=True).decode()
@@ -0,0 +1,60 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+
+# Контрольная точка ставится с запасом от текущего момента, чтобы импорты, еще идущие с датой
+# до границы, успели записать историю
+CHECKPOINT_DELAY = timedelta(minutes=1)
+# Как часто проверяется, не пора ли поставить точку и не удалена ли последняя запоздавшей историей
+CHECKPOINT_POLL_SECONDS = 60
+
+
+class HistoryCheckpointer:
+    """
+    Периодические контрольные точки истории для срезов дерева на прошлый момент.
+    Точки ставятся на границах интервала interval от начала эпохи в UTC: чем чаще точки,
+    тем меньше истории доигрывается при чтении среза и тем больше места они занимают.
+    Хранятся keep последних точек, более старые удаляются при создании новой.
+    """
+
+    def __init__(self, database, interval, keep=30):
+        self._database = database
+        self._interval = interval
+        self._keep = keep
+        self._task = None
+
+    def start(self) -> None:
+        if self._task is None and self._interval > timedelta(0):
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def checkpoint_date(self, now) -> datetime:
+        """Последняя граница интервала, которую уже можно закрыть"""
+
+        epoch = datetime(1970, 1, 1, tzinfo=timezone.utc)
+        return epoch + (now - CHECKPOINT_DELAY - epoch) // self._interval * self._interval
+
+    async def checkpoint(self, now=None) -> int:
+        # Точка собирается из node_history, поэтому сначала дописывается отложенная история
+        await self._database.flush_history()
+        return await self._database.create_history_checkpoint(
+            {'date': self.checkpoint_date(now or datetime.now(timezone.utc)), 'keep': self._keep})
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                created = await self.checkpoint()
+                if created:
+                    logging.info(f"Created history checkpoint with {created} nodes")
+            except Exception as e:
+                logging.error(f"Failed to create history checkpoint: {e}")
+            await asyncio.sleep(min(self._interval.total_seconds(), CHECKPOINT_POLL_SECONDS))
@@ -0,0 +1,91 @@
+import asyncio
+import logging
+
+
+class HistoryPurger:
+    """
+    Фоновая доочистка после DELETE. Сначала из disk_tree пачками удаляются поддеревья,
+    которые DELETE только пометил в pending_deletes, по транзакции на пачку; каждый удаленный узел
+    оставляет отметку. Затем purge снимает отметки пачками и удаляет историю по ним.
+    schedule будит фоновую задачу и сразу возвращается, чтобы DELETE не ждал очистки.
+    stop не прерывает запрос к базе, а останавливает задачу между пачками; недоделанное продолжится при запуске.
+    """
+
+    def __init__(self, database, chunk_size=10000):
+        self._database = database
+        self._chunk_size = chunk_size
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self._task = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+            # Отметки, оставшиеся с прошлого запуска, дочищаются сразу
+            self.schedule()
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        # Отмена посреди транзакции оставила бы соединение пула занятым, поэтому задача выходит сама
+        self._stopping = True
+        self._wakeup.set()
+        await self._task
+        self._task = None
+        self._stopping = False
+
+    def schedule(self) -> None:
+        self._wakeup.set()
+
+    async def purge(self) -> int:
+        await self.finish_deletes()
+        # Очередь отложенной истории может еще держать строки удаленных узлов
+        await self._database.flush_history()
+        total = 0
+        while not self._stopping:
+            purged = await self._database.purge_history({'chunk_size': self._chunk_size})
+            if not purged:
+                return total
+            total += purged
+        return total
+
+    async def finish_deletes(self) -> int:
+        deleted = 0
+        for node_id in await self._database.read_pending_deletes():
+            if self._stopping:
+                break
+            deleted += await self._finish_delete(node_id)
+        return deleted
+
+    async def _finish_delete(self, node_id) -> int:
+        deleted, after = 0, None
+        while not self._stopping:
+            chunk = await self._database.delete_pending_chunk({'id': node_id, 'chunk_size': self._chunk_size,
+                                                               'after': after})
+            if chunk is None:
+                # Поддерево дочистил другой воркер или импорт узла с тем же id
+                return deleted
+            deleted += chunk['deleted']
+            if chunk['deleted'] == self._chunk_size:
+                after = chunk['last_route']
+                continue
+            # Сам узел удаляется, только если под ним ничего не осталось; иначе проход повторяется
+            removed = await self._database.delete_node({'id': node_id})
+            if removed:
+                logging.info(f"Deleted subtree of {node_id}: {deleted + removed} nodes")
+                return deleted + removed
+            after = None
+        return deleted
+
+    async def _run(self) -> None:
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            if self._stopping:
+                return
+            try:
+                purged = await self.purge()
+                if purged:
+                    logging.info(f"Purged history of {purged} deleted nodes")
+            except Exception as e:
+                logging.error(f"Failed to purge history of deleted nodes: {e}")
@@ -0,0 +1,97 @@
+import asyncio
+import json
+import logging
+
+# Предел паузы между повторами записи пачки, которую база не принимает
+MAX_RETRY_DELAY = 5.0
+# Строки, которые не удалось записать ни пачкой, ни по одной, уходят сюда, чтобы их можно было дописать вручную
+dead_letters = logging.getLogger('history.dead_letter')
+
+
+class HistoryRecorder:
+    """
+    Отложенная запись истории: снимки узлов копятся в ограниченной очереди
+    и пишутся в базу пачками фоновой задачей. Когда очередь заполнена,
+    record ждет освобождения места; пока фоновая задача не запущена, record пишет сразу.
+    Пачка, которую база не принимает, повторяется до max_attempts раз, затем пишется по одной строке:
+    строки, не записанные и так, уходят в лог history.dead_letter, и очередь идет дальше.
+    """
+
+    def __init__(self, database, max_queue_size=10000, batch_size=1000, flush_interval=0.05, max_attempts=10):
+        self._database = database
+        self._max_attempts = max_attempts
+        self._queue = asyncio.Queue(maxsize=max_queue_size)
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        # Сколько строк поставлено в очередь и сколько из них уже записано: очередь пишется по порядку,
+        # поэтому flush ждет только строки, поставленные до него, а не опустошения очереди
+        self._recorded = 0
+        self._written = 0
+        self._written_changed = asyncio.Condition()
+        self._task = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        await self.flush()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def record(self, nodes) -> None:
+        if self._task is None:
+            await self._database.write_history({'nodes': list(nodes)})
+            return
+        for node in nodes:
+            await self._queue.put(node)
+            self._recorded += 1
+
+    async def flush(self) -> None:
+        """Дожидается записи всего, что попало в очередь до вызова"""
+
+        watermark = self._recorded
+        async with self._written_changed:
+            await self._written_changed.wait_for(lambda: self._written >= watermark)
+
+    async def _run(self) -> None:
+        while True:
+            batch = [await self._queue.get()]
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + self._flush_interval
+            while len(batch) < self._batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            await self._write(batch)
+            async with self._written_changed:
+                self._written += len(batch)
+                self._written_changed.notify_all()
+
+    async def _write(self, batch) -> None:
+        if await self._write_with_retries(batch, self._max_attempts):
+            return
+        # Одна плохая строка не должна утянуть за собой всю пачку
+        rejected = [row for row in batch if len(batch) == 1 or not await self._write_with_retries([row], 1)]
+        dead_letters.error(f"Dropped {len(rejected)} history rows: {json.dumps(rejected, default=str)}")
+
+    async def _write_with_retries(self, batch, attempts) -> bool:
+        for attempt in range(1, attempts + 1):
+            try:
+                await self._database.write_history({'nodes': batch})
+                return True
+            except Exception as e:
+                logging.error(f"Failed to write {len(batch)} history rows (attempt {attempt}): {e}")
+                if attempt < attempts:
+                    await asyncio.sleep(min(self._flush_interval * attempt, MAX_RETRY_DELAY))
+        return False
@@ -0,0 +1,182 @@
+from fastapi.exceptions import RequestValidationError
+from core.helpers import add_delta, update_parents
+from models.models import SystemItemType
+
+
+def validate_item(item) -> None:
+    if item.parentId == item.id:
+        raise RequestValidationError("Parent id can't be the same as id")
+    if item.type == SystemItemType.FOLDER and (item.url is not None or item.size is not None):
+        raise RequestValidationError("Folder can't have url or size")
+    elif item.type == SystemItemType.FILE and (item.url is None or item.size is None or item.size <= 0):
+        raise RequestValidationError("Item must have url and size")
+
+
+def resolve_routes(batch, existing) -> dict:
+    """
+    Считает full_route для всех элементов пачки. Родитель может находиться
+    в любом месте пачки или уже лежать в базе.
+    """
+    routes = {}
+    for item in batch.values():
+        chain, seen = [], set()
+        current = item
+        while current.id not in routes:
+            if current.id in seen:
+                raise RequestValidationError("Parent chain can't be cyclic")
+            chain.append(current.id)
+            seen.add(current.id)
+            if current.parentId is None or current.parentId not in batch:
+                break
+            current = batch[current.parentId]
+
+        if current.id in routes:
+            route = routes[current.id]
+        else:
+            route = ''
+            if current.parentId is not None:
+                parent_node = existing.get(current.parentId)
+                if not parent_node or parent_node.type != SystemItemType.FOLDER.value:
+                    raise RequestValidationError("Parent must exist and be a folder")
+                route = parent_node.full_route
+            route = routes[current.id] = f'{route}/{current.id}'
+            chain.pop()
+
+        for item_id in reversed(chain):
+            if batch[item_id].parentId in batch and batch[batch[item_id].parentId].type != SystemItemType.FOLDER:
+                raise RequestValidationError("Parent must exist and be a folder")
+            route = routes[item_id] = f'{route}/{item_id}'
+    return routes
+
+
+async def import_items(database, items, update_date) -> tuple:
+    """
+    Импорт пачки элементов: одно чтение всех затронутых узлов, валидация в памяти
+    и одна запись всей пачки. Вызывается внутри транзакции.
+    Возвращает id измененных узлов с их предками и старые пути перенесенных узлов.
+    """
+    batch = {item.id: item for item in items}
+    if len(batch) != len(items):
+        raise RequestValidationError("Can't have duplicate ids")
+    for item in items:
+        validate_item(item)
+
+    parent_ids = {item.parentId for item in items if item.parentId is not None}
+    ids_to_read = set(batch) | parent_ids
+    # Сначала блокируем узлы пачки и пути к ним, только потом читаем их состояние
+    await database.lock_nodes({'ids': list(batch), 'parent_ids': list(parent_ids - set(batch))})
+    existing = {node.id: node for node in await database.read_nodes({'ids': list(ids_to_read)})}
+    routes = resolve_routes(batch, existing)
+
+    values_list = []
+    for item in items:
+        existing_node = existing.get(item.id)
+        if existing_node:
+            if existing_node.type != item.type.value:
+                raise RequestValidationError("Can't change type")
+            if existing_node.type == SystemItemType.FOLDER.value and existing_node.parent_id == item.parentId:
+                raise RequestValidationError("Nothing to update")
+            if routes[item.id].startswith(f'{existing_node.full_route}/'):
+                raise RequestValidationError("Folder can't be moved into itself")
+        size = existing_node.size if existing_node and item.type == SystemItemType.FOLDER else item.size
+        values_list.append({"id": item.id, "parent_id": item.parentId, "type": item.type.value,
+                            "url": item.url, "date": update_date, "size": size,
+                            "full_route": routes[item.id]})
+
+    if not values_list:
+        return [], []
+    await database.upsert_nodes({'nodes': values_list})
+
+    moved_folders = [values['id'] for values in values_list
+                     if values['id'] in existing and values['type'] == SystemItemType.FOLDER.value]
+    if moved_folders:
+        await database.update_routes({'ids': moved_folders})
+
+    deltas = {}
+    for values in values_list:
+        existing_node = existing.get(values['id'])
+        if existing_node:
+            # Убираем старый размер из ветки, откуда был перенесен или обновлен элемент
+            add_delta(deltas, existing_node.parent_id, -(existing_node.size if existing_node.size else 0))
+        add_delta(deltas, values['parent_id'], values['size'])
+    ancestors = await update_parents(database, deltas, update_date)
+
+    moved_routes = [existing[values['id']].full_route for values in values_list
+                    if values['id'] in existing and existing[values['id']].parent_id != values['parent_id']]
+    return list(batch) + ancestors, moved_routes
+
+
+async def import_stream(database, items, update_date, chunk_size, max_pending_items) -> None:
+    """
+    Импорт потока элементов чанками. Элемент, чей родитель еще не встречался,
+    откладывается до прихода родителя, поэтому порядок элементов в потоке произвольный;
+    отложенных элементов может быть не больше max_pending_items.
+    Вызывается внутри транзакции: если родитель так и не пришел, откатывается весь импорт.
+    История каждого чанка пишется сразу, в памяти держатся только текущий чанк и отложенные элементы.
+    """
+    pending = {}
+    pending_count = 0
+
+    async def flush(candidates) -> None:
+        nonlocal pending_count
+        while candidates:
+            batch = {item.id: item for item in candidates}
+            # Родители из прошлых чанков уже записаны в этой же транзакции и видны в базе
+            outer_parents = {item.parentId for item in candidates
+                             if item.parentId is not None and item.parentId not in batch}
+            known_parents = {node.id for node in await database.read_nodes({'ids': list(outer_parents)})} \
+                if outer_parents else set()
+
+            resolvable = {}
+            for item in candidates:
+                chain, chain_ids, current = [], set(), item
+                while current.id not in resolvable:
+                    chain.append(current.id)
+                    chain_ids.add(current.id)
+                    parent_id = current.parentId
+                    if parent_id is None or parent_id in known_parents:
+                        ok = True
+                        break
+                    if parent_id not in batch or parent_id in chain_ids:
+                        ok = False
+                        break
+                    current = batch[parent_id]
+                else:
+                    ok = resolvable[current.id]
+                for item_id in chain:
+                    resolvable[item_id] = ok
+
+            ready = [item for item in candidates if resolvable[item.id]]
+            for item in candidates:
+                if not resolvable[item.id]:
+                    pending.setdefault(item.parentId, []).append(item)
+                    pending_count += 1
+            if pending_count > max_pending_items:
+                raise RequestValidationError(f"Too many items wait for their parents (more than {max_pending_items})")
+            if not ready:
+                return
+            await import_items(database, ready, update_date)
+            await database.flush_pending_history()
+
+            candidates = [child for item in ready for child in pending.pop(item.id, [])]
+            pending_count -= len(candidates)
+
+    async def add_chunk(chunk) -> None:
+        if not chunk:
+            return
+        if len({item.id for item in chunk}) != len(chunk) or await database.claim_import_ids(
+                {'ids': [item.id for item in chunk]}):
+            raise RequestValidationError("Can't have duplicate ids")
+        await flush(chunk)
+
+    chunk = []
+    async for item in items:
+        validate_item(item)
+        chunk.append(item)
+        if len(chunk) >= chunk_size:
+            await add_chunk(chunk)
+            chunk = []
+    await add_chunk(chunk)
+
+    if pending:
+        raise RequestValidationError("Parent must exist and be a folder")
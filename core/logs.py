@@ -0,0 +1,65 @@
+import atexit
+import logging
+import random
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+
+from core.streaming import dumps
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись - одна строка JSON: время, логгер, уровень, сообщение и исключение, если есть"""
+
+    def format(self, record) -> str:
+        entry = {'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+                 'logger': record.name, 'level': record.levelname, 'message': record.getMessage()}
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return dumps(entry).decode()
+
+
+class SamplingFilter(logging.Filter):
+    """Пропускает только заданную долю записей своего уровня; уровни без доли проходят целиком"""
+
+    def __init__(self, rates):
+        super().__init__()
+        self._rates = rates
+
+    def filter(self, record) -> bool:
+        rate = self._rates.get(record.levelno)
+        return rate is None or random.random() < rate
+
+
+def parse_sampling(value) -> dict:
+    """'INFO=0.1,DEBUG=0' -> {logging.INFO: 0.1, logging.DEBUG: 0.0}"""
+
+    rates = {}
+    for part in filter(None, (part.strip() for part in (value or '').split(','))):
+        level, rate = part.split('=', 1)
+        rates[logging.getLevelName(level.strip().upper())] = float(rate)
+    return rates
+
+
+def setup_logging(filename='app.log', level=logging.INFO, sampling=None) -> QueueListener:
+    """
+    Неблокирующее логирование: обработчик корневого логгера только кладет запись в очередь,
+    а форматирование и запись в файл делает поток QueueListener. Отбор по доле выполняется
+    до постановки в очередь, поэтому отброшенные записи почти ничего не стоят.
+    """
+
+    file_handler = logging.FileHandler(filename, mode='a', encoding='utf-8')
+    file_handler.setFormatter(JsonFormatter())
+    queue = SimpleQueue()
+    queue_handler = QueueHandler(queue)
+    if sampling:
+        queue_handler.addFilter(SamplingFilter(sampling))
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+    listener = QueueListener(queue, file_handler)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
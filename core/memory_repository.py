@@ -0,0 +1,638 @@
+import asyncio
+import json
+import logging
+import os
+from bisect import bisect_left, bisect_right, insort
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from datetime import datetime, timedelta, timezone
+from typing import NamedTuple, Optional
+
+from core.repository import Repository, unique_history
+
+# После стольких записей в журнале при коммите делается новый снимок
+SNAPSHOT_EVERY = 100_000
+# Больше любого id: (date, MAX_ID) идет после всех пар с той же датой
+MAX_ID = chr(0x10FFFF)
+# Сколько ключей индекса по дате выбирается за один шаг при чтении updates
+UPDATES_BATCH = 1000
+
+
+def _utc(date) -> datetime:
+    # Как и asyncpg для timestamptz, дату без зоны считаем UTC
+    return date.replace(tzinfo=timezone.utc) if date.tzinfo is None else date.astimezone(timezone.utc)
+
+
+class Node:
+    __slots__ = ('id', 'url', 'type', 'size', 'date', 'full_route', 'parent_id')
+
+    def __init__(self, id, url, type, size, date, full_route, parent_id):
+        self.id = id
+        self.url = url
+        self.type = type
+        self.size = size
+        self.date = _utc(date)
+        self.full_route = full_route
+        self.parent_id = parent_id
+
+    @classmethod
+    def from_values(cls, values):
+        return cls(values['id'], values.get('url'), values['type'], values['size'], values['date'],
+                   values.get('full_route'), values['parent_id'])
+
+    @property
+    def _mapping(self) -> dict:
+        return {slot: getattr(self, slot) for slot in self.__slots__}
+
+    def copy(self):
+        return Node(self.id, self.url, self.type, self.size, self.date, self.full_route, self.parent_id)
+
+
+class HistoryUnit(NamedTuple):
+    id: str
+    parent_id: Optional[str]
+    type: str
+    url: Optional[str]
+    size: Optional[int]
+    date: datetime
+
+
+class HistoryCheckpoint(NamedTuple):
+    date: datetime
+    # Последняя строка истории каждого узла не позже date и индекс детей по ним
+    states: dict
+    children: dict
+
+
+class SubtreePageRow(NamedTuple):
+    id: str
+    url: Optional[str]
+    type: str
+    size: Optional[int]
+    date: datetime
+    parent_id: Optional[str]
+    depth: int
+    position: int
+
+
+class MemoryRepository(Repository):
+    """
+    Хранилище дерева в памяти процесса для однонодовых инсталляций, тестов и бенчмарков.
+    Пишущие транзакции выполняются по одной и откатываются по журналу отмены.
+    Чтения берут ту же блокировку, поэтому видят только закоммиченное состояние.
+    При заданном пути состояние переживает перезапуск: снимок плюс журнал изменений;
+    файлы читает и пишет отдельный поток, пока транзакция держит блокировку.
+    """
+
+    def __init__(self, path=None):
+        self._path = path
+        self._nodes = {}
+        self._children = {}
+        self._by_date = []
+        self._history = {}
+        # Вся история по дате: срез доигрывает только строки после контрольной точки
+        self._history_by_date = []
+        self._checkpoints = []
+        self._lock = asyncio.Lock()
+        # Задача, выполняющая транзакцию, уже держит блокировку и читает без нее
+        self._in_transaction = ContextVar('memory_transaction', default=False)
+        self._files = ThreadPoolExecutor(max_workers=1, thread_name_prefix='memory-repository')
+        self._journal = None
+        self._pending_history = None
+        self._import_ids = None
+        self._history_recorder = None
+        self._log = None
+        self._log_records = 0
+
+    async def connect(self):
+        if self._path is None:
+            return
+        async with self._lock:
+            await self._in_files(self._load)
+        logging.info(f"Loaded {len(self._nodes)} nodes from {self._path}")
+
+    async def disconnect(self):
+        if self._log is None:
+            return
+        async with self._lock:
+            await self._in_files(self._close)
+
+    def _load(self) -> None:
+        if os.path.exists(self._path):
+            with open(self._path, encoding='utf-8') as snapshot:
+                for line in snapshot:
+                    self._replay(json.loads(line))
+        log_path = f'{self._path}.log'
+        if os.path.exists(log_path):
+            with open(log_path, encoding='utf-8') as log:
+                for line in log:
+                    self._replay(json.loads(line))
+                    self._log_records += 1
+        self._history_by_date = sorted((row for rows in self._history.values() for row in rows),
+                                       key=lambda unit: unit.date)
+        self._log = open(log_path, 'a', encoding='utf-8')
+
+    def _close(self) -> None:
+        self._snapshot()
+        self._log.close()
+        self._log = None
+
+    def set_history_recorder(self, history_recorder):
+        self._history_recorder = history_recorder
+
+    @asynccontextmanager
+    async def transaction(self):
+        async with self._lock:
+            token = self._in_transaction.set(True)
+            self._journal, self._pending_history, self._import_ids = {}, [], set()
+            try:
+                yield
+            except BaseException:
+                self._rollback()
+                raise
+            finally:
+                journal, pending = self._journal, self._pending_history
+                self._journal = self._pending_history = self._import_ids = None
+                self._in_transaction.reset(token)
+            await self._commit(journal, pending)
+
+    async def lock_nodes(self, query_values):
+        # Пишущие транзакции и так выполняются по одной
+        pass
+
+    async def upsert_nodes(self, query_values):
+        nodes = query_values['nodes']
+        async with self._write():
+            for values in nodes:
+                node = Node.from_values(values)
+                existing = self._nodes.get(node.id)
+                if existing is not None and node.type == 'FOLDER':
+                    node.size = existing.size
+                self._put(node)
+            self._add_history(nodes)
+
+    async def read_node(self, query_values):
+        async with self._reading():
+            node = self._nodes.get(query_values['id'])
+            return node.copy() if node is not None else None
+
+    async def read_nodes(self, query_values):
+        async with self._reading():
+            return [self._nodes[node_id].copy() for node_id in set(query_values['ids']) if node_id in self._nodes]
+
+    async def claim_import_ids(self, query_values):
+        async with self._write():
+            ids = set(query_values['ids'])
+            claimed = [node_id for node_id in ids if node_id in self._import_ids]
+            self._import_ids.update(ids)
+            return claimed
+
+    async def read_children_by_route(self, query_values):
+        async with self._reading():
+            return [node.copy() for node in self._descendants(query_values['id'])]
+
+    async def iterate_subtree(self, query_values):
+        # Поддерево копируется целиком под блокировкой, чтобы медленный клиент не держал пишущих
+        async with self._reading():
+            rows = []
+            root = self._nodes.get(query_values['id'])
+            # Прямой порядок обхода, дети по возрастанию id, как и у запроса в Postgres
+            stack = [root] if root is not None else []
+            while stack:
+                node = stack.pop()
+                rows.append(node.copy())
+                stack.extend(self._nodes[child_id]
+                             for child_id in sorted(self._children.get(node.id, ()), reverse=True))
+        for row in rows:
+            yield row
+
+    async def read_subtree_page(self, query_values):
+        async with self._reading():
+            return self._subtree_page(query_values)
+
+    def _subtree_page(self, query_values):
+        # Та же выдача, что у запроса в Postgres: дети по возрастанию id; на первом уровне после курсора
+        # и не больше limit + 1, глубже - все; раскрываются только папки не глубже depth и в пределах limit
+        limit, depth, after = query_values.get('limit'), query_values.get('depth'), query_values.get('after')
+        rows = []
+        level = [query_values['id']]
+        current_depth = 1
+        while level and (depth is None or current_depth <= depth):
+            next_level = []
+            for parent_id in level:
+                child_ids = sorted(self._children.get(parent_id, ()))
+                if current_depth == 1 and after is not None:
+                    child_ids = child_ids[bisect_right(child_ids, after):]
+                if current_depth == 1 and limit is not None:
+                    child_ids = child_ids[:limit + 1]
+                for position, child_id in enumerate(child_ids, 1):
+                    child = self._nodes[child_id]
+                    rows.append(SubtreePageRow(child.id, child.url, child.type, child.size, child.date,
+                                               child.parent_id, current_depth,
+                                               position if current_depth == 1 else 0))
+                    if child.type == 'FOLDER' and (limit is None or current_depth > 1 or position <= limit):
+                        next_level.append(child.id)
+            level = next_level
+            current_depth += 1
+        return rows
+
+    async def update_routes(self, query_values):
+        async with self._write():
+            for node_id in query_values['ids']:
+                node = self._nodes.get(node_id)
+                if node is None:
+                    continue
+                parent = self._nodes.get(node.parent_id)
+                self._set_route(node, f'{parent.full_route if parent else ""}/{node.id}')
+                for descendant in self._descendants(node.id):
+                    self._set_route(descendant, f'{self._nodes[descendant.parent_id].full_route}/{descendant.id}')
+
+    async def update_ancestors(self, query_values):
+        async with self._write():
+            totals = {}
+            for node_id, delta in query_values['deltas'].items():
+                node = self._nodes.get(node_id)
+                while node is not None:
+                    totals[node.id] = totals.get(node.id, 0) + delta
+                    node = self._nodes.get(node.parent_id)
+            history = []
+            for node_id, delta in totals.items():
+                node = self._nodes[node_id].copy()
+                node.size = (node.size if node.size else 0) + delta
+                node.date = _utc(query_values['date'])
+                self._put(node)
+                history.append(node._mapping)
+            self._add_history(history)
+        return list(totals)
+
+    async def delete_node(self, query_values):
+        async with self._write():
+            node = self._nodes.get(query_values['id'])
+            if node is None:
+                return
+            for descendant in self._descendants(node.id):
+                self._remove(descendant.id)
+            self._remove(node.id)
+
+    async def delete_subtree(self, query_values):
+        async with self._write():
+            node = self._nodes.get(query_values['id'])
+            if node is None:
+                return 0
+            descendants = self._descendants(node.id)
+            for descendant in descendants:
+                self._remove(descendant.id)
+            self._remove(node.id)
+        return len(descendants) + 1
+
+    async def mark_deleted(self, query_values):
+        # Блокировки здесь не держатся на уровне строк и журнала нет, поэтому поддерево удаляется сразу,
+        # и дочищать потом нечего
+        await self.delete_subtree(query_values)
+
+    async def read_pending_deletes(self):
+        return []
+
+    async def delete_pending_chunk(self, query_values):
+        return None
+
+    async def purge_history(self, query_values):
+        # Отметки не нужны: история без узла в дереве и есть история удаленного узла.
+        # Под блокировкой, чтобы не задеть узлы, удаленные еще не завершенной транзакцией
+        async with self._lock:
+            ids = [node_id for node_id in self._history if node_id not in self._nodes]
+            if ids:
+                self._drop_history(ids)
+                await self._persist([{'purge': ids}])
+        return len(ids)
+
+    async def updates_till_date(self, query_values):
+        async with self._reading():
+            return [node.copy() for node in self._updates(query_values)]
+
+    async def iterate_updates(self, query_values):
+        # Блокировка берется на каждую пачку, а не на всю выдачу: продолжение идет от последнего ключа
+        limit, after = query_values.get('limit'), query_values.get('after')
+        while limit is None or limit > 0:
+            batch_limit = UPDATES_BATCH if limit is None else min(limit, UPDATES_BATCH)
+            async with self._reading():
+                nodes = [node.copy() for node in self._updates(dict(query_values, after=after, limit=batch_limit))]
+            for node in nodes:
+                yield node
+            if len(nodes) < batch_limit:
+                return
+            if limit is not None:
+                limit -= len(nodes)
+            after = (nodes[-1].date, nodes[-1].id)
+
+    async def ensure_history_partitions(self, query_values):
+        pass
+
+    async def bump_nodes_to_history(self, query_values):
+        async with self._write():
+            self._add_history(query_values['nodes'])
+
+    async def flush_history(self):
+        if self._history_recorder is not None:
+            await self._history_recorder.flush()
+
+    async def flush_pending_history(self):
+        # История и так живет в памяти; в буфере транзакции остается по строке на узел и дату
+        async with self._write():
+            self._pending_history[:] = unique_history(self._pending_history)
+
+    async def write_history(self, query_values):
+        # Как и в Postgres, история уже удаленных узлов не пишется: ее некому было бы очистить
+        async with self._write():
+            self._add_history([values for values in query_values['nodes'] if values['id'] in self._nodes])
+
+    async def get_history_per_node(self, query_values):
+        async with self._reading():
+            return list(self._history_range(query_values))
+
+    async def iterate_history_per_node(self, query_values):
+        async with self._reading():
+            rows = list(self._history_range(query_values))
+        for row in rows:
+            yield row
+
+    async def create_history_checkpoint(self, query_values):
+        date = _utc(query_values['date'])
+        async with self._lock:
+            previous = self._checkpoints[-1] if self._checkpoints else None
+            if previous is not None and previous.date >= date:
+                return 0
+            # Как и в Postgres, точка собирается из предыдущей и истории после нее;
+            # удаленные, но еще не дочищенные узлы в нее не попадают
+            states = dict(previous.states) if previous is not None else {}
+            for row in self._history_between(previous.date if previous is not None else None, date):
+                states[row.id] = row
+            states = {node_id: row for node_id, row in states.items() if node_id in self._nodes}
+            children = {}
+            for row in states.values():
+                children.setdefault(row.parent_id, set()).add(row.id)
+            self._checkpoints.append(HistoryCheckpoint(date, states, children))
+            if query_values.get('keep'):
+                del self._checkpoints[:-query_values['keep']]
+            return len(states)
+
+    async def read_subtree_at(self, query_values):
+        async with self._reading():
+            return self._subtree_at(query_values)
+
+    def _subtree_at(self, query_values):
+        # Обход от ближайшей контрольной точки не позже date, как в Postgres: кандидаты в дети папки - ее дети
+        # в точке и узлы, которые ссылались на нее в истории после точки; остаются те, чей parent_id на date
+        # по-прежнему эта папка. Удаленных узлов в срезе нет, даже пока purge_history не убрал их историю
+        date = _utc(query_values['date'])
+        index = bisect_right(self._checkpoints, date, key=lambda checkpoint: checkpoint.date)
+        checkpoint = self._checkpoints[index - 1] if index else None
+        later_children = {}
+        for row in self._history_between(checkpoint.date if checkpoint is not None else None, date):
+            later_children.setdefault(row.parent_id, set()).add(row.id)
+
+        def state(node_id):
+            if node_id not in self._nodes:
+                return None
+            rows = self._history.get(node_id, ())
+            position = bisect_right(rows, date, key=lambda unit: unit.date)
+            if position and (checkpoint is None or rows[position - 1].date > checkpoint.date):
+                return rows[position - 1]
+            return checkpoint.states.get(node_id) if checkpoint is not None else None
+
+        root = state(query_values['id'])
+        if root is None:
+            return []
+        result = [root]
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            if node.type != 'FOLDER':
+                continue
+            candidates = later_children.get(node.id, set())
+            if checkpoint is not None:
+                candidates = candidates | checkpoint.children.get(node.id, set())
+            for child_id in sorted(candidates):
+                child = state(child_id)
+                if child is not None and child.parent_id == node.id:
+                    result.append(child)
+                    stack.append(child)
+        return result
+
+    async def notify_node_changes(self, query_values):
+        # Дерево в памяти не делится между процессами, уведомлять некого
+        pass
+
+    @asynccontextmanager
+    async def _reading(self):
+        if self._in_transaction.get():
+            yield
+            return
+        async with self._lock:
+            yield
+
+    @asynccontextmanager
+    async def _write(self):
+        """Изменение вне транзакции коммитится сразу, как отдельный запрос в Postgres"""
+
+        if self._in_transaction.get():
+            yield
+            return
+        async with self.transaction():
+            yield
+
+    def _touch(self, node_id) -> None:
+        if node_id not in self._journal:
+            node = self._nodes.get(node_id)
+            self._journal[node_id] = node.copy() if node is not None else None
+
+    def _rollback(self) -> None:
+        for node_id, previous in self._journal.items():
+            if previous is None:
+                if node_id in self._nodes:
+                    self._unindex(self._nodes.pop(node_id))
+            else:
+                self._restore(previous)
+
+    async def _commit(self, journal, pending) -> None:
+        records = []
+        for node_id in journal:
+            node = self._nodes.get(node_id)
+            records.append({'put': self._dump_node(node)} if node is not None else {'delete': node_id})
+        if pending:
+            rows = [self._history_unit(values) for values in unique_history(pending)]
+            self._store_history(rows)
+            records.append({'history': [self._dump_history(row) for row in rows]})
+        await self._persist(records)
+
+    async def _persist(self, records) -> None:
+        """Дописывает записи в журнал; вызывается под блокировкой, поэтому поток видит согласованное состояние"""
+
+        if self._log is not None and records:
+            await self._in_files(self._write_log, records)
+
+    async def _in_files(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._files, function, *args)
+
+    def _write_log(self, records) -> None:
+        for record in records:
+            self._append_log(record)
+        self._log.flush()
+        if self._log_records >= SNAPSHOT_EVERY:
+            self._snapshot()
+
+    def _put(self, node) -> None:
+        self._touch(node.id)
+        self._restore(node)
+
+    def _restore(self, node) -> None:
+        old = self._nodes.get(node.id)
+        if old is not None:
+            self._unindex(old)
+        self._nodes[node.id] = node
+        self._index(node)
+
+    def _remove(self, node_id) -> None:
+        self._touch(node_id)
+        self._unindex(self._nodes.pop(node_id))
+
+    def _index(self, node) -> None:
+        if node.parent_id is not None:
+            self._children.setdefault(node.parent_id, {})[node.id] = None
+        insort(self._by_date, (node.date, node.id))
+
+    def _unindex(self, node) -> None:
+        if node.parent_id is not None:
+            siblings = self._children.get(node.parent_id)
+            if siblings is not None:
+                siblings.pop(node.id, None)
+                if not siblings:
+                    del self._children[node.parent_id]
+        position = bisect_left(self._by_date, (node.date, node.id))
+        if position < len(self._by_date) and self._by_date[position] == (node.date, node.id):
+            del self._by_date[position]
+
+    def _set_route(self, node, route) -> None:
+        if node.full_route != route:
+            self._touch(node.id)
+            node.full_route = route
+
+    def _descendants(self, node_id) -> list:
+        descendants = []
+        stack = list(self._children.get(node_id, ()))
+        while stack:
+            child_id = stack.pop()
+            descendants.append(self._nodes[child_id])
+            stack.extend(self._children.get(child_id, ()))
+        return descendants
+
+    def _updates(self, query_values):
+        # Тот же порядок и курсор, что у Postgres: по (date, id), строго после after
+        date = _utc(query_values['date'])
+        key = (date - timedelta(hours=24),)
+        if query_values.get('after') is not None:
+            after_date, after_id = query_values['after']
+            key = max(key, (_utc(after_date), after_id))
+        end = (date, MAX_ID)
+        node_type, limit = query_values.get('type'), query_values.get('limit')
+        while limit is None or limit > 0:
+            # Индекс читается пачками от последнего ключа, поэтому потоковое чтение
+            # переживает изменения между пачками и не копирует весь диапазон
+            start = bisect_right(self._by_date, key)
+            batch = self._by_date[start:start + UPDATES_BATCH]
+            if not batch:
+                return
+            for key in batch:
+                if key > end:
+                    return
+                node = self._nodes.get(key[1])
+                if node is None or (node_type is not None and node.type != node_type):
+                    continue
+                yield node
+                if limit is not None:
+                    limit -= 1
+                    if limit == 0:
+                        return
+
+    def _add_history(self, nodes) -> None:
+        self._pending_history.extend(nodes)
+
+    @staticmethod
+    def _history_unit(values) -> HistoryUnit:
+        return HistoryUnit(values['id'], values['parent_id'], values['type'], values.get('url'), values['size'],
+                           _utc(values['date']))
+
+    def _store_history(self, rows, index_dates=True) -> None:
+        for row in rows:
+            insort(self._history.setdefault(row.id, []), row, key=lambda unit: unit.date)
+            if index_dates:
+                insort(self._history_by_date, row, key=lambda unit: unit.date)
+        if rows and self._checkpoints:
+            # Строка не позже контрольной точки делает точку неверной
+            earliest = min(row.date for row in rows)
+            del self._checkpoints[bisect_left(self._checkpoints, earliest, key=lambda checkpoint: checkpoint.date):]
+
+    def _drop_history(self, ids) -> None:
+        ids = set(ids)
+        for node_id in ids:
+            self._history.pop(node_id, None)
+        self._history_by_date = [row for row in self._history_by_date if row.id not in ids]
+        for checkpoint in self._checkpoints:
+            for node_id in ids:
+                row = checkpoint.states.pop(node_id, None)
+                if row is not None:
+                    checkpoint.children[row.parent_id].discard(node_id)
+
+    def _history_between(self, start, end) -> list:
+        """Строки истории с датой в (start, end], start = None - с самого начала"""
+
+        first = bisect_right(self._history_by_date, start, key=lambda unit: unit.date) if start is not None else 0
+        return self._history_by_date[first:bisect_right(self._history_by_date, end, key=lambda unit: unit.date)]
+
+    def _history_range(self, query_values) -> list:
+        rows = self._history.get(query_values['id'], [])
+        start = bisect_left(rows, _utc(query_values['date_start']), key=lambda unit: unit.date)
+        end = bisect_right(rows, _utc(query_values['date_end']), key=lambda unit: unit.date)
+        return rows[start:end]
+
+    @staticmethod
+    def _dump_node(node) -> dict:
+        return dict(node._mapping, date=node.date.isoformat())
+
+    @staticmethod
+    def _dump_history(row) -> dict:
+        return dict(row._asdict(), date=row.date.isoformat())
+
+    def _replay(self, record) -> None:
+        if 'put' in record:
+            values = record['put']
+            self._restore(Node.from_values(dict(values, date=datetime.fromisoformat(values['date']))))
+        elif 'delete' in record:
+            node = self._nodes.pop(record['delete'], None)
+            if node is not None:
+                self._unindex(node)
+        elif 'purge' in record:
+            self._drop_history(record['purge'])
+        elif 'history' in record:
+            # Индекс по дате строится одной сортировкой после загрузки
+            self._store_history([self._history_unit(dict(values, date=datetime.fromisoformat(values['date'])))
+                                 for values in record['history']], index_dates=False)
+
+    def _append_log(self, record) -> None:
+        if self._log is not None:
+            self._log.write(json.dumps(record, ensure_ascii=False) + '\n')
+            self._log_records += 1
+
+    def _snapshot(self) -> None:
+        temporary_path = f'{self._path}.tmp'
+        with open(temporary_path, 'w', encoding='utf-8') as snapshot:
+            for node in self._nodes.values():
+                snapshot.write(json.dumps({'put': self._dump_node(node)}, ensure_ascii=False) + '\n')
+            for rows in self._history.values():
+                snapshot.write(json.dumps({'history': [self._dump_history(row) for row in rows]},
+                                          ensure_ascii=False) + '\n')
+        os.replace(temporary_path, self._path)
+        self._log.truncate(0)
+        self._log.seek(0)
+        self._log_records = 0
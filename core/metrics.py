@@ -0,0 +1,174 @@
+import inspect
+import time
+from bisect import bisect_left
+from functools import wraps
+
+# Границы корзин гистограмм задержек, в секундах
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    __slots__ = ('buckets', 'sum', 'count')
+
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value) -> None:
+        self.buckets[bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _labels(labels) -> str:
+    return ','.join(f'{name}="{value}"' for name, value in labels)
+
+
+class Metrics:
+    """
+    Счетчики и гистограммы задержек в памяти процесса, отдаются в текстовом формате Prometheus.
+    Метрика задается именем и кортежем пар (метка, значение).
+    """
+
+    def __init__(self):
+        self._histograms = {}
+        self._counters = {}
+        self._help = {}
+
+    def describe(self, name, text) -> None:
+        self._help[name] = text
+
+    def observe(self, name, labels, value) -> None:
+        key = (name, labels)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = Histogram()
+        histogram.observe(value)
+
+    def increment(self, name, labels, value=1) -> None:
+        key = (name, labels)
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def snapshot(self) -> dict:
+        """{(имя, метки): (число вызовов, суммарное время)} по всем гистограммам"""
+
+        return {key: (histogram.count, histogram.sum) for key, histogram in self._histograms.items()}
+
+    def render(self, gauges=None) -> str:
+        lines = []
+        described = set()
+
+        def header(name, kind):
+            if name not in described:
+                described.add(name)
+                if name in self._help:
+                    lines.append(f'# HELP {name} {self._help[name]}')
+                lines.append(f'# TYPE {name} {kind}')
+
+        for (name, labels), histogram in sorted(self._histograms.items()):
+            header(name, 'histogram')
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), histogram.buckets):
+                cumulative += count
+                bucket_labels = _labels(labels + (('le', bound),))
+                lines.append(f'{name}_bucket{{{bucket_labels}}} {cumulative}')
+            lines.append(f'{name}_sum{{{_labels(labels)}}} {histogram.sum}')
+            lines.append(f'{name}_count{{{_labels(labels)}}} {histogram.count}')
+        for (name, labels), value in sorted(self._counters.items()):
+            header(name, 'counter')
+            lines.append(f'{name}{{{_labels(labels)}}} {value}')
+        for name, value in sorted((gauges or {}).items()):
+            header(name, 'gauge')
+            lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+class InstrumentedRepository:
+    """
+    Прокси над Repository: время и ошибки каждого асинхронного метода и потокового чтения
+    попадают в metrics, остальное передается как есть.
+    """
+
+    def __init__(self, repository, metrics):
+        self._repository = repository
+        self._metrics = metrics
+        metrics.describe('repository_call_duration_seconds', 'Repository method latency')
+        metrics.describe('repository_call_errors_total', 'Repository method failures')
+
+    def __getattr__(self, name):
+        attribute = getattr(self._repository, name)
+        if inspect.isasyncgenfunction(attribute):
+            wrapped = self._wrap_iterator(name, attribute)
+        elif inspect.iscoroutinefunction(attribute):
+            wrapped = self._wrap_call(name, attribute)
+        else:
+            return attribute
+        # Обертка создается один раз на метод, дальше берется из атрибутов экземпляра
+        setattr(self, name, wrapped)
+        return wrapped
+
+    def _wrap_call(self, name, method):
+        labels = (('method', name),)
+
+        @wraps(method)
+        async def call(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await method(*args, **kwargs)
+            except Exception:
+                self._metrics.increment('repository_call_errors_total', labels)
+                raise
+            finally:
+                self._metrics.observe('repository_call_duration_seconds', labels, time.perf_counter() - start)
+
+        return call
+
+    def _wrap_iterator(self, name, method):
+        labels = (('method', name),)
+
+        @wraps(method)
+        async def iterate(*args, **kwargs):
+            # Время считается до конца выдачи, включая ожидание клиента между порциями
+            start = time.perf_counter()
+            try:
+                async for row in method(*args, **kwargs):
+                    yield row
+            except Exception:
+                self._metrics.increment('repository_call_errors_total', labels)
+                raise
+            finally:
+                self._metrics.observe('repository_call_duration_seconds', labels, time.perf_counter() - start)
+
+        return iterate
+
+
+class MetricsMiddleware:
+    """ASGI-прослойка: задержка каждого запроса по методу, шаблону пути и коду ответа"""
+
+    def __init__(self, app, metrics):
+        self._app = app
+        self._metrics = metrics
+        metrics.describe('http_request_duration_seconds', 'HTTP request latency until the last body chunk')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self._app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        try:
+            await self._app(scope, receive, send_wrapper)
+        finally:
+            # Шаблон пути вместо самого пути, чтобы id не плодили метки; scope['route'] ставит роутер FastAPI
+            route = scope.get('route')
+            labels = (('method', scope['method']), ('route', route.path if route is not None else 'unmatched'),
+                      ('status', status))
+            self._metrics.observe('http_request_duration_seconds', labels, time.perf_counter() - start)
@@ -0,0 +1,140 @@
+import asyncio
+import json
+import logging
+import os
+import re
+import sys
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import asyncpg
+
+from core.engines import postgres_dsn
+from core.nodes_repository import CLEANUP_CHUNK_SIZE, NodesRepository
+
+MIGRATIONS_DIR = Path(__file__).resolve().parent.parent / 'migrations'
+MIGRATION_FILE = re.compile(r'^(\d+)_(\w+)\.sql$')
+# Ключ pg_advisory_lock, чтобы несколько воркеров не накатывали миграции одновременно
+MIGRATIONS_LOCK_KEY = 7_390_041
+
+# Горячие запросы, которые обязаны идти по индексам: те же строки, что выполняет NodesRepository,
+# с примерами параметров. Значения должны отбирать немного строк, как в рабочих запросах
+SAMPLE_DATE = datetime(2022, 5, 29, tzinfo=timezone.utc)
+HOT_QUERIES = {
+    'read_subtree_page': NodesRepository._subtree_page_query({'id': 'id', 'after': 'after', 'limit': 100,
+                                                              'depth': 2}),
+    'read_children_by_route': NodesRepository._children_by_route_query({'route': '/id'}),
+    'updates_till_date': NodesRepository._updates_query({'date': SAMPLE_DATE, 'limit': 1001,
+                                                         'after': (SAMPLE_DATE - timedelta(hours=12), 'id')}),
+    'updates_till_date_by_type': NodesRepository._updates_query({'date': SAMPLE_DATE, 'type': 'FILE',
+                                                                 'limit': 1001}),
+    'delete_subtree': (NodesRepository._delete_chunk_query(),
+                       {'route_start': '/id/', 'route_end': '/id0', 'chunk_size': CLEANUP_CHUNK_SIZE}),
+    'get_history_per_node': (NodesRepository._history_query(),
+                             {'id': 'id', 'date_start': SAMPLE_DATE - timedelta(days=1), 'date_end': SAMPLE_DATE}),
+    'read_subtree_at': NodesRepository._subtree_at_query({'id': 'id', 'date': SAMPLE_DATE}),
+}
+# pending_deletes держит только корни еще не дочищенных удалений, и читать ее целиком дешево:
+# VISIBLE сравнивает с ней пути по префиксу, и индекс здесь не поможет
+SMALL_TABLES = {'pending_deletes'}
+NAMED_PARAMETER = re.compile(r'(?<!:):(\w+)')
+
+
+def list_migrations() -> list:
+    migrations = []
+    for path in sorted(MIGRATIONS_DIR.iterdir()):
+        match = MIGRATION_FILE.match(path.name)
+        if match:
+            migrations.append((int(match.group(1)), match.group(2), path))
+    return migrations
+
+
+async def apply_migrations(connection_string) -> list:
+    """Накатывает все еще не примененные миграции по порядку версий. Возвращает примененные версии"""
+
+    connection = await asyncpg.connect(connection_string)
+    applied_now = []
+    try:
+        await connection.execute("SELECT pg_advisory_lock($1)", MIGRATIONS_LOCK_KEY)
+        await connection.execute("CREATE TABLE IF NOT EXISTS schema_migrations ("
+                                 "version integer primary key, name varchar not null, "
+                                 "applied_at timestamptz not null default now())")
+        applied = {row['version'] for row in await connection.fetch("SELECT version FROM schema_migrations")}
+        for version, name, path in list_migrations():
+            if version in applied:
+                continue
+            logging.info(f"Applying migration {version} {name}")
+            async with connection.transaction():
+                await connection.execute(path.read_text())
+                await connection.execute("INSERT INTO schema_migrations (version, name) VALUES ($1, $2)",
+                                         version, name)
+            applied_now.append(version)
+            logging.info(f"Successfully applied migration {version} {name}")
+    finally:
+        await connection.execute("SELECT pg_advisory_unlock($1)", MIGRATIONS_LOCK_KEY)
+        await connection.close()
+    return applied_now
+
+
+def _positional(query, values) -> tuple:
+    # Запросы NodesRepository написаны с именованными параметрами databases, asyncpg ждет $1, $2...
+    names = []
+
+    def number(match):
+        if match.group(1) not in names:
+            names.append(match.group(1))
+        return f"${names.index(match.group(1)) + 1}"
+
+    return NAMED_PARAMETER.sub(number, query), [values[name] for name in names]
+
+
+def _seq_scans(plan) -> list:
+    scans = []
+    if plan.get('Node Type') == 'Seq Scan' and plan.get('Relation Name') not in SMALL_TABLES:
+        scans.append(plan.get('Relation Name'))
+    for child in plan.get('Plans', []):
+        scans.extend(_seq_scans(child))
+    return scans
+
+
+async def check_query_plans(connection_string) -> dict:
+    """
+    Проверяет через EXPLAIN, что горячие запросы не скатываются в последовательное сканирование.
+    enable_seqscan = off заставляет планировщик взять индекс, если он вообще применим,
+    поэтому Seq Scan в плане означает, что подходящего индекса нет.
+    Возвращает {запрос: [таблицы с Seq Scan]} только для проблемных запросов.
+    """
+
+    connection = await asyncpg.connect(connection_string)
+    failures = {}
+    try:
+        async with connection.transaction():
+            await connection.execute("SET LOCAL enable_seqscan = off")
+            for name, (query, values) in HOT_QUERIES.items():
+                query, arguments = _positional(query, values)
+                plan = json.loads(await connection.fetchval(f"EXPLAIN (FORMAT JSON) {query}", *arguments))[0]['Plan']
+                scans = _seq_scans(plan)
+                if scans:
+                    failures[name] = scans
+    finally:
+        await connection.close()
+    return failures
+
+
+async def main(command) -> int:
+    connection_string = postgres_dsn(os.environ['database_url'])
+    if command == 'apply':
+        applied = await apply_migrations(connection_string)
+        print(f"Applied migrations: {applied}" if applied else "Database is up to date")
+        return 0
+    if command == 'check':
+        failures = await check_query_plans(connection_string)
+        for name, tables in failures.items():
+            print(f"{name}: sequential scan on {', '.join(tables)}")
+        return 1 if failures else 0
+    print("Usage: python -m core.migrations [apply|check]")
+    return 2
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main(sys.argv[1] if len(sys.argv) > 1 else 'apply')))
@@ -0,0 +1,91 @@
+import asyncio
+import json
+import logging
+import os
+from uuid import uuid4
+
+import asyncpg
+
+CHANNEL = 'node_changes'
+# NOTIFY принимает не больше 8000 байт; событие крупнее заменяется полным сбросом кэша
+MAX_PAYLOAD_BYTES = 7900
+RECONNECT_SECONDS = 1.0
+
+
+class NodeEvents:
+    """
+    Согласование локальных кэшей нескольких воркеров через LISTEN/NOTIFY Postgres.
+    Изменивший дерево воркер отправляет событие в той же транзакции, поэтому остальные получают его
+    только после коммита; каждый воркер слушает канал на отдельном соединении и сбрасывает у себя
+    записи кэша по id и путям из события. Без connection_string (движок в памяти) ничего не делает.
+    """
+
+    def __init__(self, connection_string, cache):
+        self._connection_string = connection_string
+        self._cache = cache
+        self._sender = f'{os.getpid()}-{uuid4().hex[:8]}'
+        self._task = None
+
+    def notification(self, ids=(), routes=(), clear=False) -> dict:
+        """Параметры для Repository.notify_node_changes"""
+
+        event = {'sender': self._sender, 'ids': list(ids), 'routes': list(routes)}
+        payload = json.dumps(event, ensure_ascii=False)
+        if clear or len(payload.encode()) > MAX_PAYLOAD_BYTES:
+            payload = json.dumps({'sender': self._sender, 'clear': True})
+        return {'channel': CHANNEL, 'payload': payload}
+
+    def start(self) -> None:
+        if self._task is None and self._connection_string is not None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def _on_notification(self, connection, pid, channel, payload) -> None:
+        try:
+            event = json.loads(payload)
+        except ValueError:
+            logging.error(f"Malformed node change event: {payload[:200]}")
+            self._cache.clear()
+            return
+        # Свой кэш воркер уже сбросил сам после коммита
+        if event.get('sender') == self._sender:
+            return
+        if event.get('clear'):
+            self._cache.clear()
+        else:
+            self._cache.invalidate(event.get('ids', ()), event.get('routes', ()))
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self._listen()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Failed to listen for node changes: {e}")
+            # События, пришедшие без подписки, потеряны: кэш сбрасывается целиком
+            self._cache.clear()
+            await asyncio.sleep(RECONNECT_SECONDS)
+
+    async def _listen(self) -> None:
+        connection = await asyncpg.connect(self._connection_string)
+        lost = asyncio.Event()
+        connection.add_termination_listener(lambda _: lost.set())
+        try:
+            await connection.add_listener(CHANNEL, self._on_notification)
+            self._cache.clear()
+            logging.info("Listening for node changes")
+            await lost.wait()
+            logging.error("Lost connection listening for node changes")
+        finally:
+            if not connection.is_closed():
+                await connection.close()
@@ -1,23 +1,45 @@
-from core.repository import Repository
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from core.repository import PendingHistory, Repository, unique_history
 from databases import Database
 import logging
-import json
-from core.helpers import json_serial
-from datetime import timedelta
+from datetime import timedelta, timezone
 from fastapi import HTTPException
 
-logging.basicConfig(filename='app.log',
-                    filemode='a',
-                    format='%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s',
-                    datefmt='%H:%M:%S',
-                    level=logging.INFO)
+# Ключ блокировки, которой создание контрольной точки истории упорядочено с записью истории
+CHECKPOINT_LOCK_KEY = 7_390_042
+# Поддеревья из pending_deletes уже удалены для клиентов. Обходы по parent_id не заходят в них,
+# если исключить корни; строки, найденные по id или по пути, проверяются по префиксу пути
+NOT_PENDING_DELETE = "NOT IN (SELECT id FROM pending_deletes)"
+VISIBLE = "NOT EXISTS (SELECT 1 FROM pending_deletes d " \
+          "WHERE t.id = d.id OR starts_with(t.full_route, d.full_route || '/'))"
+# Пачка, которой импорт дочищает поддерево, еще стоящее в очереди на удаление
+CLEANUP_CHUNK_SIZE = 10000
+# Состояние узла candidate.id на :date: последняя строка истории после контрольной точки, иначе строка самой точки.
+# Из строк с одной датой берется записанная последней
+HISTORY_STATE = "SELECT s.id, s.parent_id, s.type, s.url, s.size, s.date FROM ((" \
+                "SELECT h.id, h.parent_id, h.type, h.url, h.size, h.date, 1 AS priority FROM node_history h " \
+                "WHERE h.id = candidate.id AND h.date > checkpoint.date AND h.date <= CAST(:date AS timestamptz) " \
+                "ORDER BY h.date DESC, h.seq DESC LIMIT 1" \
+                ") UNION ALL (" \
+                "SELECT c.id, c.parent_id, c.type, c.url, c.size, c.date, 0 FROM history_checkpoint c " \
+                "WHERE c.id = candidate.id AND c.checkpoint_date = checkpoint.date" \
+                ")) s ORDER BY s.priority DESC LIMIT 1"
 
 
 class NodesRepository(Repository):
-    def __init__(self, connection_string):
+    database_class = Database
+
+    def __init__(self, connection_string, **pool_options):
         # initialize database connection
         self._connection_string = connection_string
-        self._connection = Database(connection_string)
+        self._connection = self.database_class(connection_string, **pool_options)
+        self._history_recorder = None
+        # История, накопленная в текущей транзакции; уходит в recorder только после коммита
+        self._pending_history = ContextVar('pending_history', default=None)
+
+    def set_history_recorder(self, history_recorder):
+        self._history_recorder = history_recorder
 
     async def connect(self):
         await self._connection.connect()
@@ -25,24 +47,77 @@ class NodesRepository(Repository):
     async def disconnect(self):
         await self._connection.disconnect()
 
-    async def create_node(self, query_values):
-        id_to_add = query_values['id']
-        logging.info(f"Attempting to add node {id_to_add}")
+    @asynccontextmanager
+    async def transaction(self):
+        pending = PendingHistory()
+        token = self._pending_history.set(pending)
+        try:
+            async with self._connection.transaction():
+                yield
+                # Без очереди история пишется в той же транзакции
+                if pending and (self._history_recorder is None or pending.written):
+                    await self.flush_pending_history()
+        finally:
+            self._pending_history.reset(token)
+        if pending and self._history_recorder is not None:
+            await self._history_recorder.record(unique_history(pending))
+
+    async def lock_nodes(self, query_values):
+        ids_to_lock = query_values['ids']
+        logging.info(f"Attempting to lock {len(ids_to_lock)} nodes with their ancestors")
+        # Изменяемые узлы блокируются исключительно, их родители и все предки - разделяемо:
+        # импорты в соседние ветки не ждут друг друга, а перенос или удаление папки (исключительная
+        # блокировка) ждет импортов под ней, чьи пути от нее зависят. Размеры предков меняются
+        # атомарно в update_ancestors. Блокировки берутся одним запросом в порядке ключа,
+        # поэтому пересекающиеся транзакции встают в очередь, а не попадают в deadlock
+        query = "WITH RECURSIVE chain (id, parent_id) AS (" \
+                "SELECT id, parent_id FROM disk_tree WHERE id = ANY(:ids) OR id = ANY(:parent_ids) " \
+                "UNION " \
+                "SELECT p.id, p.parent_id FROM chain c JOIN disk_tree p ON p.id = c.parent_id" \
+                "), lock_keys AS (" \
+                "SELECT hashtext(id) AS lock_key, bool_or(exclusive) AS exclusive FROM (" \
+                "SELECT id, false AS exclusive FROM chain UNION ALL " \
+                "SELECT unnest(CAST(:ids AS varchar[])), true" \
+                ") ids GROUP BY hashtext(id)" \
+                ") " \
+                "SELECT count(CASE WHEN exclusive THEN pg_advisory_xact_lock(lock_key) " \
+                "ELSE pg_advisory_xact_lock_shared(lock_key) END) " \
+                "FROM (SELECT lock_key, exclusive FROM lock_keys ORDER BY lock_key) ordered"
+        values = {"ids": list(ids_to_lock), "parent_ids": list(query_values.get('parent_ids', ()))}
+        try:
+            await self._connection.execute(query=query, values=values)
+            logging.info(f"Successfully locked {len(ids_to_lock)} nodes with their ancestors")
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Failed to lock {len(ids_to_lock)} nodes: {e}")
+
+    async def upsert_nodes(self, query_values):
+        nodes = query_values['nodes']
+        logging.info(f"Attempting to upsert {len(nodes)} nodes")
 
         query = "INSERT INTO disk_tree (id, url, type, size, date, full_route, parent_id) " \
-                "VALUES (:id, :url, :type, :size, :date, :full_route, :parent_id) RETURNING id"
+                "SELECT * FROM unnest(CAST(:ids AS varchar[]), CAST(:urls AS varchar[]), " \
+                "CAST(:types AS varchar[]), CAST(:sizes AS integer[]), CAST(:dates AS timestamptz[]), " \
+                "CAST(:full_routes AS varchar[]), CAST(:parent_ids AS varchar[])) " \
+                "ON CONFLICT (id) DO UPDATE SET url = EXCLUDED.url, date = EXCLUDED.date, " \
+                "size = CASE WHEN EXCLUDED.type = 'FOLDER' THEN disk_tree.size ELSE EXCLUDED.size END, " \
+                "full_route = EXCLUDED.full_route, parent_id = EXCLUDED.parent_id"
+        values = {"ids": [node['id'] for node in nodes], "urls": [node['url'] for node in nodes],
+                  "types": [node['type'] for node in nodes], "sizes": [node['size'] for node in nodes],
+                  "dates": [node['date'] for node in nodes], "full_routes": [node['full_route'] for node in nodes],
+                  "parent_ids": [node['parent_id'] for node in nodes]}
 
         try:
-            node_id = await self._connection.execute(query=query, values=query_values)
-            logging.info(f"Successfully added node {node_id}")
-            await self.bump_node_to_history(query_values)
+            await self._delete_pending_nodes(values["ids"])
+            await self._connection.execute(query=query, values=values)
+            logging.info(f"Successfully upserted {len(nodes)} nodes")
+            await self.bump_nodes_to_history({'nodes': nodes})
         except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Failed to add node {id_to_add}: {e}")
+            raise HTTPException(status_code=500, detail=f"Failed to upsert {len(nodes)} nodes: {e}")
 
     async def read_node(self, query_values):
         id_to_read = query_values['id']
         logging.info(f"Attempting to read node {id_to_read}")
-        query = "SELECT * FROM disk_tree WHERE id = :node_id"
+        query = f"SELECT * FROM disk_tree t WHERE t.id = :node_id AND {VISIBLE}"
         values = {"node_id": id_to_read}
         try:
             result = await self._connection.fetch_one(query=query, values=values)
@@ -51,63 +126,343 @@ class NodesRepository(Repository):
             raise HTTPException(status_code=500, detail=f"Failed to fetch node {id_to_read} from database: {e}")
         return result
 
-    async def read_children(self, query_values):
-        id_to_read = query_values['id']
-        logging.info(f"Attempting to read children of node {id_to_read}")
-        query = "SELECT * FROM disk_tree WHERE parent_id = :parent_id"
-        values = {"parent_id": id_to_read}
+    async def read_nodes(self, query_values):
+        ids_to_read = query_values['ids']
+        logging.info(f"Attempting to read {len(ids_to_read)} nodes")
+        query = f"SELECT * FROM disk_tree t WHERE t.id = ANY(:ids) AND {VISIBLE}"
+        values = {"ids": list(ids_to_read)}
         try:
             result = await self._connection.fetch_all(query=query, values=values)
-            logging.info(f"Successfully read children of node {id_to_read}")
+            logging.info(f"Successfully read {len(result)} nodes")
         except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Failed to fetch children of {id_to_read} from database: {e}")
+            raise HTTPException(status_code=500, detail=f"Failed to fetch {len(ids_to_read)} nodes from database: {e}")
         return result
 
+    async def claim_import_ids(self, query_values):
+        """
+        Запоминает id потокового импорта во временной таблице транзакции.
+        Возвращает те из них, что уже встречались раньше в этом импорте
+        """
+
+        ids = query_values['ids']
+        logging.info(f"Attempting to claim {len(ids)} import ids")
+        create_query = "CREATE TEMP TABLE IF NOT EXISTS import_ids (id varchar PRIMARY KEY) ON COMMIT DROP"
+        query = "WITH claimed AS (INSERT INTO import_ids SELECT DISTINCT unnest(CAST(:ids AS varchar[])) " \
+                "ON CONFLICT DO NOTHING RETURNING id) " \
+                "SELECT DISTINCT u.id FROM unnest(CAST(:ids AS varchar[])) AS u (id) " \
+                "WHERE u.id NOT IN (SELECT id FROM claimed)"
+        try:
+            await self._connection.execute(query=create_query)
+            result = await self._connection.fetch_all(query=query, values={"ids": list(ids)})
+            logging.info(f"Successfully claimed {len(ids)} import ids")
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Failed to claim {len(ids)} import ids: {e}")
+        return [row.id for row in result]
+
+    @staticmethod
+    def _children_by_route_query(query_values):
+        # Диапазон [route + '/', route + '0') по индексу text_pattern_ops: '0' идет сразу за '/'.
+        # Поддеревья в очереди на удаление отбрасывает build_tree: их корня нет в выдаче
+        route = query_values['route']
+        query = "SELECT * FROM disk_tree WHERE full_route ~>=~ :route_start AND full_route ~<~ :route_end " \
+                f"AND id {NOT_PENDING_DELETE}"
+        return query, {"route_start": route + '/', "route_end": route + '0'}
+
     async def read_children_by_route(self, query_values):
         id_to_read = query_values['id']
-        route = query_values['route']
         logging.info(f"Attempting to read children of node {id_to_read}")
-        query = f"SELECT * FROM disk_tree WHERE full_route LIKE '%{route}%'"
+        query, values = self._children_by_route_query(query_values)
         try:
-            result = await self._connection.fetch_all(query=query)
+            result = await self._connection.fetch_all(query=query, values=values)
             logging.info(f"Successfully read children of node {id_to_read}")
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Failed to fetch children of {id_to_read} from database: {e}")
         return result
 
-    async def update_node(self, query_values):
-        id_to_update = query_values['id']
-        date = query_values['date']
-        size = query_values['size']
-        url = query_values['url'] if 'url' in query_values else None
-        parent_id = query_values['parent_id']
-        logging.info(f"Attempting to update node {id_to_update}")
-        query = "UPDATE disk_tree SET date = :date, url = :url, size = :size, " \
-                "parent_id = :parent_id WHERE id = :node_id"
-        values = {"node_id": id_to_update, "date": date, "size": size, "parent_id": parent_id, "url": url}
+    async def iterate_subtree(self, query_values):
+        id_to_read = query_values['id']
+        logging.info(f"Attempting to stream subtree of node {id_to_read}")
+        # Сортировка по пути из id дает прямой порядок обхода: каждое поддерево идет целиком
+        query = "WITH RECURSIVE subtree AS (" \
+                "SELECT t.*, ARRAY[t.id] AS path FROM disk_tree t WHERE t.id = :id " \
+                "UNION ALL " \
+                "SELECT c.*, subtree.path || c.id FROM subtree JOIN disk_tree c ON c.parent_id = subtree.id " \
+                f"WHERE c.id {NOT_PENDING_DELETE}" \
+                ") SELECT id, url, type, size, date, parent_id FROM subtree ORDER BY path"
+        values = {"id": id_to_read}
+        try:
+            async for row in self._connection.iterate(query=query, values=values):
+                yield row
+            logging.info(f"Successfully streamed subtree of node {id_to_read}")
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Failed to stream subtree of {id_to_read} from database: {e}")
+
+    @staticmethod
+    def _subtree_page_query(query_values):
+        # limit и курсор after относятся только к прямым детям узла, в порядке id; их берется на одного больше:
+        # строка с position > limit только показывает, что есть следующая страница, и не раскрывается.
+        # Вложенные папки отдаются целиком до глубины depth, обрезанных списков детей в ответе нет
+        query = "WITH RECURSIVE subtree AS ((" \
+                "SELECT c.id, c.url, c.type, c.size, c.date, c.parent_id, 1 AS depth, " \
+                "row_number() OVER (ORDER BY c.id COLLATE \"C\") AS position " \
+                f"FROM disk_tree c WHERE c.parent_id = :id AND c.id {NOT_PENDING_DELETE} " \
+                "AND (CAST(:after AS varchar) IS NULL OR c.id COLLATE \"C\" > CAST(:after AS varchar)) " \
+                "ORDER BY c.id COLLATE \"C\" LIMIT CAST(:limit AS bigint) + 1" \
+                ") UNION ALL " \
+                "SELECT c.id, c.url, c.type, c.size, c.date, c.parent_id, s.depth + 1, 0 " \
+                "FROM subtree s JOIN disk_tree c ON c.parent_id = s.id " \
+                f"WHERE c.id {NOT_PENDING_DELETE} AND s.type = 'FOLDER' " \
+                "AND (CAST(:depth AS integer) IS NULL OR s.depth < CAST(:depth AS integer)) " \
+                "AND (CAST(:limit AS bigint) IS NULL OR s.position <= CAST(:limit AS bigint))" \
+                ") SELECT id, url, type, size, date, parent_id, depth, position FROM subtree " \
+                "ORDER BY id COLLATE \"C\""
+        values = {"id": query_values['id'], "after": query_values.get('after'), "limit": query_values.get('limit'),
+                  "depth": query_values.get('depth')}
+        return query, values
+
+    async def read_subtree_page(self, query_values):
+        id_to_read = query_values['id']
+        logging.info(f"Attempting to read subtree page of node {id_to_read}")
+        query, values = self._subtree_page_query(query_values)
+        try:
+            result = await self._connection.fetch_all(query=query, values=values)
+            logging.info(f"Successfully read subtree page of node {id_to_read}")
+        except Exception as e:
+            raise HTTPException(status_code=500,
+                                detail=f"Failed to fetch subtree page of {id_to_read} from database: {e}")
+        return result
+
+    async def update_routes(self, query_values):
+        ids_to_update = query_values['ids']
+        logging.info(f"Attempting to update routes under {len(ids_to_update)} nodes")
+        # Путь каждого перенесенного узла собирается по цепочке parent_id, затем переписывается все поддерево
+        query = "WITH RECURSIVE up (moved_id, parent_id, full_route) AS (" \
+                "SELECT id, parent_id, '/' || id FROM disk_tree WHERE id = ANY(:ids) " \
+                "UNION ALL " \
+                "SELECT up.moved_id, p.parent_id, '/' || p.id || up.full_route " \
+                "FROM up JOIN disk_tree p ON p.id = up.parent_id" \
+                "), down (id, full_route) AS (" \
+                "SELECT moved_id, full_route FROM up WHERE parent_id IS NULL " \
+                "UNION ALL " \
+                "SELECT c.id, down.full_route || '/' || c.id FROM down JOIN disk_tree c ON c.parent_id = down.id " \
+                f"WHERE c.id {NOT_PENDING_DELETE}" \
+                ") " \
+                "UPDATE disk_tree t SET full_route = routes.full_route " \
+                "FROM (SELECT DISTINCT id, full_route FROM down) routes WHERE t.id = routes.id"
+        values = {"ids": list(ids_to_update)}
         try:
             await self._connection.execute(query=query, values=values)
-            logging.info(f"Successfully updated node {id_to_update}")
-            await self.bump_node_to_history(query_values)
+            logging.info(f"Successfully updated routes under {len(ids_to_update)} nodes")
         except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Failed to update node {id_to_update} from database: {e}")
+            raise HTTPException(status_code=500,
+                                detail=f"Failed to update routes under {len(ids_to_update)} nodes: {e}")
+
+    async def update_ancestors(self, query_values):
+        deltas = query_values['deltas']
+        logging.info(f"Attempting to update ancestors of {len(deltas)} nodes")
+        # Строки предков сначала блокируются в порядке id: параллельные импорты поднимают размеры
+        # общих предков, и без общего порядка их UPDATE могли бы взять блокировки навстречу друг другу
+        lock_query = "WITH RECURSIVE walk (id, parent_id) AS (" \
+                     "SELECT id, parent_id FROM disk_tree WHERE id = ANY(:ids) " \
+                     "UNION " \
+                     "SELECT p.id, p.parent_id FROM walk w JOIN disk_tree p ON p.id = w.parent_id" \
+                     ") SELECT count(*) FROM (" \
+                     "SELECT id FROM disk_tree WHERE id IN (SELECT id FROM walk) ORDER BY id FOR NO KEY UPDATE" \
+                     ") locked"
+        query = "WITH RECURSIVE deltas (id, delta) AS (" \
+                "SELECT * FROM unnest(CAST(:ids AS varchar[]), CAST(:deltas AS bigint[]))" \
+                "), walk (id, parent_id, delta) AS (" \
+                "SELECT t.id, t.parent_id, d.delta FROM deltas d JOIN disk_tree t ON t.id = d.id " \
+                "UNION ALL " \
+                "SELECT p.id, p.parent_id, w.delta FROM walk w JOIN disk_tree p ON p.id = w.parent_id" \
+                "), totals AS (" \
+                "SELECT id, SUM(delta) AS delta FROM walk GROUP BY id" \
+                "), updated AS (" \
+                "UPDATE disk_tree t SET size = CAST(COALESCE(t.size, 0) + totals.delta AS integer), date = :date " \
+                "FROM totals WHERE t.id = totals.id " \
+                "RETURNING t.id, t.url, t.type, t.size, t.date, t.parent_id" \
+                ") SELECT * FROM updated"
+        values = {"ids": list(deltas), "deltas": list(deltas.values()), "date": query_values['date']}
+        try:
+            await self._connection.execute(query=lock_query, values={"ids": values["ids"]})
+            result = await self._connection.fetch_all(query=query, values=values)
+            logging.info(f"Successfully updated {len(result)} ancestors")
+            # История предков идет тем же путем, что и история пачки, и сливается с ней по узлу
+            await self.bump_nodes_to_history({'nodes': [
+                {'id': row.id, 'parent_id': row.parent_id, 'type': row.type, 'url': row.url, 'size': row.size,
+                 'date': row.date} for row in result]})
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Failed to update ancestors of {len(deltas)} nodes: {e}")
+        return [row.id for row in result]
 
     async def delete_node(self, query_values):
         id_to_delete = query_values['id']
         logging.info(f"Attempting to delete node {id_to_delete}")
-        query = "DELETE FROM disk_tree WHERE id = :node_id"
+        # Последний шаг удаления из pending_deletes: узел удаляется, только когда под ним уже ничего нет,
+        # иначе ON DELETE CASCADE снова удалил бы все поддерево в одной транзакции
+        query = "WITH doomed AS (" \
+                "SELECT d.id FROM pending_deletes d WHERE d.id = :node_id AND NOT EXISTS (" \
+                "SELECT 1 FROM disk_tree t " \
+                "WHERE t.full_route ~>=~ (d.full_route || '/') AND t.full_route ~<~ (d.full_route || '0')" \
+                ") FOR UPDATE" \
+                "), deleted AS (" \
+                "DELETE FROM disk_tree t USING doomed WHERE t.id = doomed.id RETURNING t.id" \
+                "), tombstones AS (" \
+                "INSERT INTO node_tombstones (id) SELECT id FROM deleted" \
+                "), cleared AS (" \
+                "DELETE FROM pending_deletes d USING doomed WHERE d.id = doomed.id" \
+                ") SELECT count(*) FROM doomed"
         values = {"node_id": id_to_delete}
         try:
-            await self._connection.execute(query=query, values=values)
-            logging.info(f"Successfully deleted node {id_to_delete}")
+            deleted = await self._connection.execute(query=query, values=values)
+            logging.info(f"Successfully deleted {deleted} nodes with id {id_to_delete}")
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Failed to delete node {id_to_delete} from database: {e}")
+        return deleted
+
+    @staticmethod
+    def _delete_chunk_query():
+        # Потомки удаляются пачками в обратном порядке full_route по индексу text_pattern_ops:
+        # путь предка - префикс путей потомков, поэтому каждый узел уходит после всего своего поддерева,
+        # и ON DELETE CASCADE не находит детей. Следующая пачка начинается ниже последнего удаленного пути,
+        # чтобы не просматривать заново мертвые записи индекса; COLLATE "C" сравнивает так же, как ~<~.
+        # В поддерево никто не пишет: оно заблокировано lock_nodes или уже скрыто pending_deletes
+        return "WITH doomed AS (" \
+               "SELECT ctid FROM disk_tree WHERE full_route ~>=~ :route_start AND full_route ~<~ :route_end " \
+               "ORDER BY full_route USING ~>~ LIMIT :chunk_size" \
+               "), deleted AS (" \
+               "DELETE FROM disk_tree WHERE ctid = ANY(ARRAY(SELECT ctid FROM doomed)) RETURNING id, full_route" \
+               "), tombstones AS (" \
+               "INSERT INTO node_tombstones (id) SELECT id FROM deleted" \
+               "), cleared AS (" \
+               "DELETE FROM pending_deletes d USING deleted WHERE d.id = deleted.id" \
+               ") SELECT count(*) AS deleted, min(full_route COLLATE \"C\") AS last_route FROM deleted"
+
+    async def delete_subtree(self, query_values):
+        id_to_delete = query_values['id']
+        route = query_values['route']
+        chunk_size = query_values['chunk_size']
+        logging.info(f"Attempting to delete subtree of node {id_to_delete}")
+        # Все поддерево в текущей транзакции
+        query = self._delete_chunk_query()
+        values = {"route_start": route + '/', "route_end": route + '0', "chunk_size": chunk_size}
+        root_query = "WITH deleted AS (" \
+                     "DELETE FROM disk_tree WHERE id = :id RETURNING id" \
+                     "), tombstones AS (" \
+                     "INSERT INTO node_tombstones (id) SELECT id FROM deleted" \
+                     "), cleared AS (" \
+                     "DELETE FROM pending_deletes d USING deleted WHERE d.id = deleted.id" \
+                     ") SELECT count(*) FROM deleted"
+        deleted = 0
+        try:
+            while True:
+                chunk = await self._connection.fetch_one(query=query, values=values)
+                deleted += chunk.deleted
+                if chunk.deleted < chunk_size:
+                    break
+                values["route_end"] = chunk.last_route
+            deleted += await self._connection.execute(query=root_query, values={"id": id_to_delete})
+            logging.info(f"Successfully deleted {deleted} nodes under {id_to_delete}")
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Failed to delete subtree of {id_to_delete}: {e}")
+        return deleted
+
+    async def mark_deleted(self, query_values):
+        id_to_delete = query_values['id']
+        logging.info(f"Attempting to mark subtree of node {id_to_delete} as deleted")
+        query = "INSERT INTO pending_deletes (id, full_route) VALUES (:id, :route) ON CONFLICT (id) DO NOTHING"
+        try:
+            await self._connection.execute(query=query, values={"id": id_to_delete, "route": query_values['route']})
+            logging.info(f"Successfully marked subtree of node {id_to_delete} as deleted")
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Failed to mark subtree of {id_to_delete} as deleted: {e}")
+
+    async def read_pending_deletes(self):
+        logging.info("Attempting to read pending deletes")
+        try:
+            result = await self._connection.fetch_all(query="SELECT id FROM pending_deletes")
+            logging.info(f"Successfully read {len(result)} pending deletes")
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Failed to read pending deletes: {e}")
+        return [row.id for row in result]
+
+    async def delete_pending_chunk(self, query_values):
+        id_to_delete = query_values['id']
+        chunk_size = query_values['chunk_size']
+        logging.info(f"Attempting to delete a chunk under node {id_to_delete}")
+        # Каждая пачка - отдельная транзакция: блокировки строк и WAL не копятся до конца удаления.
+        # Строка pending_deletes держится до коммита, чтобы воркеры не удаляли одно поддерево наперегонки
+        try:
+            async with self._connection.transaction():
+                pending = await self._connection.fetch_one(
+                    query="SELECT full_route FROM pending_deletes WHERE id = :id FOR UPDATE",
+                    values={"id": id_to_delete})
+                if pending is None:
+                    logging.info(f"Subtree of node {id_to_delete} is already deleted")
+                    return None
+                route = pending.full_route
+                values = {"route_start": route + '/', "route_end": query_values.get('after') or route + '0',
+                          "chunk_size": chunk_size}
+                chunk = await self._connection.fetch_one(query=self._delete_chunk_query(), values=values)
+            logging.info(f"Successfully deleted {chunk.deleted} nodes under {id_to_delete}")
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Failed to delete a chunk under {id_to_delete}: {e}")
+        return {'deleted': chunk.deleted, 'last_route': chunk.last_route}
+
+    async def _delete_pending_nodes(self, ids):
+        # Импорт узла с id из еще не вычищенного поддерева сначала дочищает его в своей транзакции.
+        # Пока pending_deletes пуста, подзапрос без корреляции отсекает весь поиск
+        query = "SELECT t.id, t.full_route FROM disk_tree t " \
+                "WHERE EXISTS (SELECT 1 FROM pending_deletes) AND t.id = ANY(:ids) " \
+                f"AND NOT {VISIBLE}"
+        for node in await self._connection.fetch_all(query=query, values={"ids": ids}):
+            await self.delete_subtree({'id': node.id, 'route': node.full_route, 'chunk_size': CLEANUP_CHUNK_SIZE})
+
+    async def purge_history(self, query_values):
+        logging.info("Attempting to purge history of deleted nodes")
+        # Вместе с историей уходят и строки контрольных точек.
+        # Если узел с тем же id успели импортировать заново, его история остается
+        query = "WITH batch AS (" \
+                "DELETE FROM node_tombstones WHERE ctid = ANY(ARRAY(" \
+                "SELECT ctid FROM node_tombstones LIMIT :chunk_size FOR UPDATE SKIP LOCKED" \
+                ")) RETURNING id" \
+                "), purged AS (" \
+                "DELETE FROM node_history h USING batch WHERE h.id = batch.id " \
+                "AND NOT EXISTS (SELECT 1 FROM disk_tree t WHERE t.id = batch.id)" \
+                "), purged_checkpoints AS (" \
+                "DELETE FROM history_checkpoint c USING batch WHERE c.id = batch.id " \
+                "AND NOT EXISTS (SELECT 1 FROM disk_tree t WHERE t.id = batch.id)" \
+                ") SELECT count(*) FROM batch"
+        try:
+            purged = await self._connection.execute(query=query, values={"chunk_size": query_values['chunk_size']})
+            logging.info(f"Successfully purged history of {purged} deleted nodes")
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Failed to purge history of deleted nodes: {e}")
+        return purged
+
+    @staticmethod
+    def _updates_query(query_values):
+        # Выдача упорядочена по (date, id): курсор продолжает ее строго после последнего отданного узла
+        date = query_values['date']
+        query = "SELECT id, url, type, size, date, parent_id FROM disk_tree t " \
+                f"WHERE date <= :end_date and date >= :start_date and {VISIBLE}"
+        values = {"start_date": date - timedelta(hours=24), "end_date": date}
+        if query_values.get('after') is not None:
+            query += " and (date, id) > (:after_date, :after_id)"
+            values["after_date"], values["after_id"] = query_values['after']
+        if query_values.get('type') is not None:
+            query += " and type = :type"
+            values["type"] = query_values['type']
+        query += " ORDER BY date, id"
+        if query_values.get('limit') is not None:
+            query += " LIMIT :limit"
+            values["limit"] = query_values['limit']
+        return query, values
 
     async def updates_till_date(self, query_values):
         date = query_values['date']
         logging.info(f"Attempting to get history: 24H back from {date}")
-        query = "SELECT * FROM disk_tree WHERE date <= :end_date and date >= :start_date"
-        values = {"start_date": date - timedelta(hours=24), "end_date": date}
+        query, values = self._updates_query(query_values)
         try:
             nodes = await self._connection.fetch_all(query=query, values=values)
             logging.info(f"Successfully fetched history 24H back from {date}")
@@ -115,31 +470,96 @@ class NodesRepository(Repository):
             raise HTTPException(status_code=500, detail=f"Failed to fetch history 24H back from {date}: {e}")
         return nodes
 
-    async def node_to_history(self, query_values):
-        id_to_add = query_values['id']
-        logging.info(f"Attempting to put node {id_to_add} to history")
+    async def iterate_updates(self, query_values):
+        date = query_values['date']
+        logging.info(f"Attempting to stream history: 24H back from {date}")
+        query, values = self._updates_query(query_values)
+        try:
+            async for row in self._connection.iterate(query=query, values=values):
+                yield row
+            logging.info(f"Successfully streamed history 24H back from {date}")
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Failed to stream history 24H back from {date}: {e}")
+
+    async def ensure_history_partitions(self, query_values):
+        # Партиции нарезаны по месяцам в UTC; asyncpg трактует даты без зоны как UTC
+        months = {(date.astimezone(timezone.utc) if date.tzinfo else date).replace(
+            day=1, hour=0, minute=0, second=0, microsecond=0) for date in query_values['dates']}
+        query = "SELECT ensure_node_history_partition(month) FROM unnest(CAST(:months AS timestamptz[])) month"
+        await self._connection.execute(query=query, values={"months": list(months)})
+
+    async def bump_nodes_to_history(self, query_values):
+        pending = self._pending_history.get()
+        if pending is not None:
+            pending.extend(query_values['nodes'])
+        elif self._history_recorder is None:
+            await self.write_history(query_values)
+        else:
+            await self._history_recorder.record(query_values['nodes'])
+
+    async def flush_history(self):
+        if self._history_recorder is not None:
+            await self._history_recorder.flush()
+
+    async def flush_pending_history(self):
+        """Пишет накопленную историю транзакции в ней же, чтобы длинный импорт не держал ее в памяти"""
+
+        pending = self._pending_history.get()
+        if not pending:
+            return
+        await self.write_history({'nodes': unique_history(pending), 'replace': pending.written})
+        pending.written = True
+        pending.clear()
+
+    async def write_history(self, query_values):
+        nodes = query_values['nodes']
+        logging.info(f"Attempting to put {len(nodes)} nodes to history")
+        # Запись по ходу транзакции заменяет строки тех же узлов с той же датой, записанные раньше в ней:
+        # предок, затронутый несколькими чанками импорта, остается в истории одной строкой
+        replace_query = "DELETE FROM node_history h USING unnest(CAST(:ids AS varchar[]), " \
+                        "CAST(:dates AS timestamptz[])) AS r (id, date) WHERE h.id = r.id AND h.date = r.date"
 
-        query = "INSERT INTO node_history (id, content, date) " \
-                "VALUES (:id, :content, :date) RETURNING id"
+        # Строки узлов, удаленных раньше, чем до них дошла очередь, не пишутся: их отметки могли уже
+        # снять, и такую историю никто бы не очистил. FOR KEY SHARE держит узлы до коммита,
+        # поэтому удаление, идущее параллельно, дождется этой записи, а его очистка увидит ее строки
+        query = "INSERT INTO node_history (id, parent_id, type, url, size, date) " \
+                "SELECT * FROM unnest(CAST(:ids AS varchar[]), CAST(:parent_ids AS varchar[]), " \
+                "CAST(:types AS varchar[]), CAST(:urls AS varchar[]), CAST(:sizes AS integer[]), " \
+                "CAST(:dates AS timestamptz[])) AS h (id, parent_id, type, url, size, date) " \
+                "WHERE h.id IN (SELECT t.id FROM disk_tree t WHERE t.id = ANY(CAST(:ids AS varchar[])) FOR KEY SHARE)"
+        values = {"ids": [node['id'] for node in nodes], "parent_ids": [node['parent_id'] for node in nodes],
+                  "types": [node['type'] for node in nodes], "urls": [node.get('url') for node in nodes],
+                  "sizes": [node['size'] for node in nodes], "dates": [node['date'] for node in nodes]}
 
         try:
-            node_id = await self._connection.execute(query=query, values=query_values)
-            logging.info(f"Successfully put node {node_id} to history")
+            await self.ensure_history_partitions({'dates': values['dates']})
+            async with self._connection.transaction():
+                if query_values.get('replace'):
+                    await self._connection.execute(query=replace_query,
+                                                   values={"ids": values["ids"], "dates": values["dates"]})
+                await self._connection.execute(query=query, values=values)
+                await self._expire_checkpoints(min(values['dates']))
+            logging.info(f"Successfully put {len(nodes)} nodes to history")
         except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Failed to put node {id_to_add} to history: {e}")
+            raise HTTPException(status_code=500, detail=f"Failed to put {len(nodes)} nodes to history: {e}")
 
-    async def bump_node_to_history(self, query_values):
-        query_values['parentId'] = query_values['parent_id']
-        if 'full_route' in query_values:
-            del query_values['full_route']
-        history_json = json.dumps(query_values, default=json_serial)
-        query_value_history = {'id': query_values['id'], 'content': history_json, 'date': query_values['date']}
-        await self.node_to_history(query_value_history)
+    async def _expire_checkpoints(self, date):
+        # Строка истории не позже контрольной точки делает точку неверной, и точка удаляется.
+        # Разделяемая блокировка не мешает параллельным записям, но ждет создающую точку транзакцию,
+        # так что новая строка либо попадет в точку, либо увидит ее и удалит
+        await self._connection.execute(query="SELECT pg_advisory_xact_lock_shared(:key)",
+                                       values={"key": CHECKPOINT_LOCK_KEY})
+        await self._connection.execute(query="DELETE FROM history_checkpoint WHERE checkpoint_date >= :date",
+                                       values={"date": date})
+
+    @staticmethod
+    def _history_query():
+        return "SELECT * FROM node_history WHERE id = :id and (date <= :date_end and date >= :date_start)"
 
     async def get_history_per_node(self, query_values):
         id_to_find = query_values['id']
         logging.info(f"Attempting to get history for element {id_to_find}")
-        query = "SELECT * FROM node_history WHERE id = :id and (date <= :date_end and date >= :date_start)"
+        query = self._history_query()
         try:
             nodes = await self._connection.fetch_all(query=query, values=query_values)
             logging.info(f"Successfully fetched history for element {id_to_find}")
@@ -147,3 +567,102 @@ class NodesRepository(Repository):
             raise HTTPException(status_code=500, detail=f"Failed to fetch history for element {id_to_find}: {e}")
         return nodes
 
+    async def iterate_history_per_node(self, query_values):
+        id_to_find = query_values['id']
+        logging.info(f"Attempting to stream history for element {id_to_find}")
+        query = self._history_query()
+        try:
+            async for row in self._connection.iterate(query=query, values=query_values):
+                yield row
+            logging.info(f"Successfully streamed history for element {id_to_find}")
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Failed to stream history for element {id_to_find}: {e}")
+
+    async def create_history_checkpoint(self, query_values):
+        checkpoint_date = query_values['date']
+        logging.info(f"Attempting to create history checkpoint at {checkpoint_date}")
+        # Новая точка собирается из предыдущей и истории после нее: последняя строка каждого узла не позже date,
+        # при равных датах - записанная последней.
+        # Узлы, удаленные, но еще не дочищенные purge_history, в точку не попадают
+        query = "WITH previous AS (" \
+                "SELECT max(checkpoint_date) AS date FROM history_checkpoint" \
+                "), inserted AS (" \
+                "INSERT INTO history_checkpoint (checkpoint_date, id, parent_id, type, url, size, date) " \
+                "SELECT DISTINCT ON (s.id) CAST(:date AS timestamptz), s.id, s.parent_id, s.type, s.url, s.size, " \
+                "s.date FROM (" \
+                "SELECT c.id, c.parent_id, c.type, c.url, c.size, c.date, 0 AS seq " \
+                "FROM history_checkpoint c, previous WHERE c.checkpoint_date = previous.date " \
+                "UNION ALL " \
+                "SELECT h.id, h.parent_id, h.type, h.url, h.size, h.date, h.seq FROM node_history h, previous " \
+                "WHERE h.date > coalesce(previous.date, '-infinity') AND h.date <= CAST(:date AS timestamptz)" \
+                ") s " \
+                "WHERE NOT EXISTS (SELECT 1 FROM previous WHERE previous.date >= CAST(:date AS timestamptz)) " \
+                "AND NOT EXISTS (SELECT 1 FROM node_tombstones d WHERE d.id = s.id " \
+                "AND NOT EXISTS (SELECT 1 FROM disk_tree t WHERE t.id = s.id)) " \
+                "ORDER BY s.id, s.date DESC, s.seq DESC " \
+                "ON CONFLICT DO NOTHING RETURNING 1" \
+                ") SELECT count(*) FROM inserted"
+        # Хранятся только keep последних точек: срезы до самой старой из них доигрывают историю с начала
+        retention_query = "DELETE FROM history_checkpoint WHERE checkpoint_date < (" \
+                          "SELECT checkpoint_date FROM (SELECT DISTINCT checkpoint_date FROM history_checkpoint) d " \
+                          "ORDER BY checkpoint_date DESC OFFSET CAST(:keep AS integer) - 1 LIMIT 1)"
+        try:
+            async with self._connection.transaction():
+                await self._connection.execute(query="SELECT pg_advisory_xact_lock(:key)",
+                                               values={"key": CHECKPOINT_LOCK_KEY})
+                created = await self._connection.execute(query=query, values={"date": checkpoint_date})
+                if created and query_values.get('keep'):
+                    await self._connection.execute(query=retention_query, values={"keep": query_values['keep']})
+            logging.info(f"Successfully created history checkpoint at {checkpoint_date} with {created} nodes")
+        except Exception as e:
+            raise HTTPException(status_code=500,
+                                detail=f"Failed to create history checkpoint at {checkpoint_date}: {e}")
+        return created
+
+    @staticmethod
+    def _subtree_at_query(query_values):
+        # Обход по уровням от ближайшей контрольной точки не позже date. Кандидаты в дети папки — ее дети
+        # в точке и узлы, которые ссылались на нее в истории после точки; остаются те, чей parent_id на date
+        # по-прежнему эта папка. Как и живые чтения, срез не показывает удаленные узлы, даже если purge_history
+        # еще не убрал их историю. Размер папок в строках не пересчитан, его собирает вызывающая сторона
+        alive = f"EXISTS (SELECT 1 FROM disk_tree t WHERE t.id = state.id AND {VISIBLE})"
+        query = "WITH RECURSIVE checkpoint AS (" \
+                "SELECT coalesce(max(checkpoint_date), '-infinity') AS date FROM history_checkpoint " \
+                "WHERE checkpoint_date <= CAST(:date AS timestamptz)" \
+                "), subtree AS (" \
+                "SELECT state.* FROM checkpoint CROSS JOIN (SELECT CAST(:id AS varchar) AS id) candidate " \
+                f"CROSS JOIN LATERAL ({HISTORY_STATE}) state WHERE {alive} " \
+                "UNION ALL " \
+                "SELECT state.* FROM subtree p CROSS JOIN checkpoint CROSS JOIN LATERAL (" \
+                "SELECT c.id FROM history_checkpoint c " \
+                "WHERE c.checkpoint_date = checkpoint.date AND c.parent_id = p.id " \
+                "UNION " \
+                "SELECT h.id FROM node_history h " \
+                "WHERE h.parent_id = p.id AND h.date > checkpoint.date AND h.date <= CAST(:date AS timestamptz)" \
+                f") candidate CROSS JOIN LATERAL ({HISTORY_STATE}) state " \
+                f"WHERE p.type = 'FOLDER' AND state.parent_id = p.id AND {alive}" \
+                ") SELECT id, url, type, size, date, parent_id FROM subtree"
+        return query, {"id": query_values['id'], "date": query_values['date']}
+
+    async def read_subtree_at(self, query_values):
+        id_to_read, date = query_values['id'], query_values['date']
+        logging.info(f"Attempting to read subtree of node {id_to_read} at {date}")
+        query, values = self._subtree_at_query(query_values)
+        try:
+            result = await self._connection.fetch_all(query=query, values=values)
+            logging.info(f"Successfully read subtree of node {id_to_read} at {date}")
+        except Exception as e:
+            raise HTTPException(status_code=500,
+                                detail=f"Failed to fetch subtree of {id_to_read} at {date} from database: {e}")
+        return result
+
+    async def notify_node_changes(self, query_values):
+        channel = query_values['channel']
+        logging.info(f"Attempting to notify {channel}")
+        # Внутри транзакции уведомление уходит слушателям только после коммита
+        query = "SELECT pg_notify(:channel, :payload)"
+        try:
+            await self._connection.execute(query=query, values=query_values)
+            logging.info(f"Successfully notified {channel}")
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Failed to notify {channel}: {e}")
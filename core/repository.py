@@ -1,6 +1,24 @@
 from abc import ABC, abstractmethod
 
 
+def unique_history(nodes) -> list:
+    """
+    Одна строка истории на узел и дату: в импорте папка может попасть в историю и как элемент пачки,
+    и как предок, чей размер изменился; остается последнее состояние
+    """
+
+    return list({(node['id'], node['date']): node for node in nodes}.values())
+
+
+class PendingHistory(list):
+    """
+    История текущей транзакции. После первой записи внутри транзакции (written) остаток тоже пишется в ней,
+    заменяя уже записанные строки тех же узлов с той же датой
+    """
+
+    written = False
+
+
 class Repository(ABC):
     @abstractmethod
     async def connect(self):
@@ -11,7 +29,19 @@ class Repository(ABC):
         pass
 
     @abstractmethod
-    async def create_node(self, query_values):
+    def set_history_recorder(self, history_recorder):
+        pass
+
+    @abstractmethod
+    def transaction(self):
+        pass
+
+    @abstractmethod
+    async def lock_nodes(self, query_values):
+        pass
+
+    @abstractmethod
+    async def upsert_nodes(self, query_values):
         pass
 
     @abstractmethod
@@ -19,7 +49,11 @@ class Repository(ABC):
         pass
 
     @abstractmethod
-    async def read_children(self, query_values):
+    async def read_nodes(self, query_values):
+        pass
+
+    @abstractmethod
+    async def claim_import_ids(self, query_values):
         pass
 
     @abstractmethod
@@ -27,25 +61,89 @@ class Repository(ABC):
         pass
 
     @abstractmethod
-    async def update_node(self, query_values):
+    def iterate_subtree(self, query_values):
+        pass
+
+    @abstractmethod
+    async def read_subtree_page(self, query_values):
+        pass
+
+    @abstractmethod
+    async def update_routes(self, query_values):
+        pass
+
+    @abstractmethod
+    async def update_ancestors(self, query_values):
         pass
 
     @abstractmethod
     async def delete_node(self, query_values):
         pass
 
+    @abstractmethod
+    async def delete_subtree(self, query_values):
+        pass
+
+    @abstractmethod
+    async def mark_deleted(self, query_values):
+        pass
+
+    @abstractmethod
+    async def read_pending_deletes(self):
+        pass
+
+    @abstractmethod
+    async def delete_pending_chunk(self, query_values):
+        pass
+
+    @abstractmethod
+    async def purge_history(self, query_values):
+        pass
+
     @abstractmethod
     async def updates_till_date(self, query_values):
         pass
 
     @abstractmethod
-    async def node_to_history(self, query_values):
+    def iterate_updates(self, query_values):
         pass
 
     @abstractmethod
-    async def bump_node_to_history(self, query_values):
+    async def ensure_history_partitions(self, query_values):
+        pass
+
+    @abstractmethod
+    async def bump_nodes_to_history(self, query_values):
+        pass
+
+    @abstractmethod
+    async def flush_history(self):
+        pass
+
+    @abstractmethod
+    async def flush_pending_history(self):
+        pass
+
+    @abstractmethod
+    async def write_history(self, query_values):
         pass
 
     @abstractmethod
     async def get_history_per_node(self, query_values):
         pass
+
+    @abstractmethod
+    def iterate_history_per_node(self, query_values):
+        pass
+
+    @abstractmethod
+    async def create_history_checkpoint(self, query_values):
+        pass
+
+    @abstractmethod
+    async def read_subtree_at(self, query_values):
+        pass
+
+    @abstractmethod
+    async def notify_node_changes(self, query_values):
+        pass
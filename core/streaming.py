@@ -0,0 +1,109 @@
+import json
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson необязателен, есть запасной вариант на json
+    orjson = None
+
+from models.models import SystemItemType
+
+# Размер буфера, который отдается клиенту за один раз
+CHUNK_SIZE = 64 * 1024
+
+
+def format_date(value):
+    """Дата в том же виде, что и у pydantic: UTC записывается как Z"""
+
+    text = value.isoformat()
+    return text[:-6] + 'Z' if text.endswith('+00:00') else text
+
+
+if orjson is not None:
+    def dumps(obj) -> bytes:
+        return orjson.dumps(obj)
+else:
+    def dumps(obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode()
+
+
+def node_dict(node) -> dict:
+    """Поля SystemItem в порядке схемы, без children"""
+
+    return {'id': node.id, 'url': node.url, 'date': format_date(node.date), 'parentId': node.parent_id,
+            'type': node.type, 'size': node.size}
+
+
+def history_unit_dict(node) -> dict:
+    """Поля SystemItemHistoryUnit в порядке схемы"""
+
+    return {'id': node.id, 'url': node.url, 'parentId': node.parent_id, 'type': node.type, 'size': node.size,
+            'date': format_date(node.date)}
+
+
+async def chunked(parts):
+    buffer = bytearray()
+    async for part in parts:
+        buffer += part
+        if len(buffer) >= CHUNK_SIZE:
+            yield bytes(buffer)
+            buffer.clear()
+    if buffer:
+        yield bytes(buffer)
+
+
+async def _subtree_parts(rows):
+    # rows идут в прямом порядке обхода: сначала корень, затем каждое поддерево целиком
+    open_ids = []
+    open_set = set()
+    root_written = False
+    first_child = True
+    async for row in rows:
+        if open_ids:
+            if row.parent_id not in open_set:
+                continue
+            while open_ids[-1] != row.parent_id:
+                open_set.discard(open_ids.pop())
+                yield b']}'
+                first_child = False
+            if not first_child:
+                yield b','
+        elif root_written:
+            break
+
+        encoded = dumps(node_dict(row))
+        root_written = True
+        if row.type == SystemItemType.FOLDER.value:
+            yield encoded[:-1] + b',"children":['
+            open_ids.append(row.id)
+            open_set.add(row.id)
+            first_child = True
+        else:
+            yield encoded[:-1] + b',"children":null}'
+            first_child = False
+
+    while open_ids:
+        open_ids.pop()
+        yield b']}'
+
+
+def stream_subtree(rows):
+    """Потоковая сериализация дерева SystemItem из строк базы без промежуточных моделей"""
+
+    return chunked(_subtree_parts(rows))
+
+
+async def _items_parts(rows, to_dict):
+    yield b'{"items":['
+    first = True
+    async for row in rows:
+        if not first:
+            yield b','
+        yield dumps(to_dict(row))
+        first = False
+    yield b']}'
+
+
+def stream_items(rows, to_dict=history_unit_dict):
+    """Потоковая сериализация SystemItemHistoryResponse"""
+
+    return chunked(_items_parts(rows, to_dict))
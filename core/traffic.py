@@ -0,0 +1,48 @@
+import atexit
+import json
+import logging
+import time
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+
+
+class TrafficRecorder:
+    """
+    ASGI-прослойка, дописывающая каждый HTTP-запрос строкой JSONL: смещение от старта, метод, путь,
+    строка запроса и тело. Файл воспроизводится через python -m bench.runner replay.
+    Как и логи, строки пишет в файл отдельный поток через очередь, а не цикл событий.
+    """
+
+    def __init__(self, app, path):
+        self._app = app
+        file_handler = logging.FileHandler(path, mode='a', encoding='utf-8')
+        queue = SimpleQueue()
+        self._logger = logging.getLogger(f'traffic.{path}')
+        self._logger.propagate = False
+        self._logger.setLevel(logging.INFO)
+        self._logger.addHandler(QueueHandler(queue))
+        self._listener = QueueListener(queue, file_handler)
+        self._listener.start()
+        atexit.register(self._listener.stop)
+        self._started = time.monotonic()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self._app(scope, receive, send)
+            return
+        offset = time.monotonic() - self._started
+        body = bytearray()
+
+        async def receive_wrapper():
+            message = await receive()
+            if message['type'] == 'http.request':
+                body.extend(message.get('body', b''))
+            return message
+
+        try:
+            await self._app(scope, receive_wrapper, send)
+        finally:
+            self._logger.info(json.dumps({'t': round(offset, 6), 'method': scope['method'], 'path': scope['path'],
+                                          'query': scope['query_string'].decode('latin-1'),
+                                          'body': body.decode('utf-8', 'replace') if body else None},
+                                         ensure_ascii=False))
@@ -1,15 +1,20 @@
 from __future__ import annotations
-from routes.router import router, database
+from routes.router import (
+    router, database, history_checkpointer, history_purger, history_recorder, metrics, node_events, DATABASE_URL,
+)
+from core.engines import is_memory_url, postgres_dsn
+from core.logs import parse_sampling, setup_logging
+from core.metrics import MetricsMiddleware
+from core.migrations import apply_migrations
+from core.traffic import TrafficRecorder
 import logging
+import os
 from fastapi.responses import JSONResponse
 from fastapi import FastAPI
 from fastapi.exceptions import RequestValidationError, HTTPException
 
-logging.basicConfig(filename='app.log',
-                    filemode='a',
-                    format='%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s',
-                    datefmt='%H:%M:%S',
-                    level=logging.INFO)
+setup_logging(filename=os.environ.get('log_file', 'app.log'), level=os.environ.get('log_level', 'INFO').upper(),
+              sampling=parse_sampling(os.environ.get('log_sampling')))
 
 logging.info('API is starting up')
 
@@ -40,11 +45,24 @@ async def custom_http_exception_handler(request, exc):
 
 @app.on_event("startup")
 async def startup_database():
+    if not is_memory_url(DATABASE_URL):
+        await apply_migrations(postgres_dsn(DATABASE_URL))
     await database.connect()
+    history_recorder.start()
+    history_purger.start()
+    history_checkpointer.start()
+    node_events.start()
 
 
 @app.on_event("shutdown")
 async def shutdown_database():
+    await node_events.stop()
+    await history_checkpointer.stop()
+    await history_purger.stop()
+    await history_recorder.stop()
     await database.disconnect()
 
+app.add_middleware(MetricsMiddleware, metrics=metrics)
+if os.environ.get('record_traffic'):
+    app.add_middleware(TrafficRecorder, path=os.environ['record_traffic'])
 app.include_router(router)
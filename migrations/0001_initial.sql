@@ -0,0 +1,18 @@
+create table if not exists disk_tree (
+  id varchar primary key not null,
+  url varchar,
+  type varchar,
+  size integer,
+  full_route varchar,
+  date timestamptz,
+  parent_id varchar,
+  foreign key (parent_id) references disk_tree(id) on delete cascade
+);
+
+create index if not exists disk_tree_full_route_idx on disk_tree (full_route text_pattern_ops);
+
+create table if not exists node_history (
+  id varchar,
+  content jsonb,
+  date timestamptz
+);
@@ -0,0 +1,8 @@
+-- read_children, рекурсивные обходы и ON DELETE CASCADE ищут детей по parent_id
+create index if not exists disk_tree_parent_id_idx on disk_tree (parent_id);
+
+-- updates_till_date
+create index if not exists disk_tree_date_idx on disk_tree (date);
+
+-- get_history_per_node
+create index if not exists node_history_id_date_idx on node_history (id, date);
@@ -0,0 +1,64 @@
+-- История хранится в типизированных колонках, по месячным партициям по date.
+-- Старые партиции удаляются или отсоединяются для архива через drop_node_history_partitions_before.
+set local timezone = 'UTC';
+
+alter table node_history rename to node_history_json;
+alter index if exists node_history_id_date_idx rename to node_history_json_id_date_idx;
+
+create table node_history (
+  id varchar not null,
+  parent_id varchar,
+  type varchar not null,
+  url varchar,
+  size integer,
+  date timestamptz not null
+) partition by range (date);
+
+create index node_history_id_date_idx on node_history (id, date);
+
+create function ensure_node_history_partition(moment timestamptz) returns void
+language plpgsql as $$
+declare
+  month_start timestamptz := date_trunc('month', moment at time zone 'UTC') at time zone 'UTC';
+  partition_name text := 'node_history_' || to_char(moment at time zone 'UTC', 'YYYY_MM');
+begin
+  if to_regclass(partition_name) is null then
+    perform pg_advisory_xact_lock(hashtext(partition_name));
+    execute format('create table if not exists %I partition of node_history for values from (%L) to (%L)',
+                   partition_name, month_start, month_start + interval '1 month');
+  end if;
+end $$;
+
+create function drop_node_history_partitions_before(cutoff timestamptz, detach_only boolean default false)
+returns setof text
+language plpgsql as $$
+declare
+  partition_name text;
+begin
+  for partition_name in
+    select c.relname from pg_inherits i join pg_class c on c.oid = i.inhrelid
+    where i.inhparent = 'node_history'::regclass
+      and c.relname ~ '^node_history_\d{4}_\d{2}$'
+      and (to_date(substring(c.relname from '\d{4}_\d{2}$'), 'YYYY_MM') + interval '1 month')
+          at time zone 'UTC' <= cutoff
+    order by c.relname
+  loop
+    execute format('alter table node_history detach partition %I', partition_name);
+    if not detach_only then
+      execute format('drop table %I', partition_name);
+    end if;
+    return next partition_name;
+  end loop;
+end $$;
+
+select ensure_node_history_partition(month) from (
+  select distinct date_trunc('month', date) as month from node_history_json where date is not null
+) months;
+
+insert into node_history (id, parent_id, type, url, size, date)
+select h.id, h.content->>'parent_id', coalesce(h.content->>'type', t.type), h.content->>'url',
+       (h.content->>'size')::integer, h.date
+from node_history_json h left join disk_tree t on t.id = h.id
+where h.date is not null and coalesce(h.content->>'type', t.type) is not null;
+
+drop table node_history_json;
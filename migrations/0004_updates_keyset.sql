@@ -0,0 +1,8 @@
+-- Постраничный updates_till_date идет по ключу (date, id): и диапазон дат, и курсор, и сортировка из одного индекса
+create index if not exists disk_tree_date_id_idx on disk_tree (date, id);
+
+-- то же с фильтром по типу
+create index if not exists disk_tree_type_date_id_idx on disk_tree (type, date, id);
+
+-- префикс (date) покрывается новым индексом
+drop index if exists disk_tree_date_idx;
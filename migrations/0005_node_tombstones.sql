@@ -0,0 +1,5 @@
+-- Отметки об удаленных узлах: по ним история удаляется пачками уже после ответа на DELETE.
+-- Без ключа: отметки только дописываются и выбираются пачками по ctid, повторы безвредны
+create table if not exists node_tombstones (
+  id varchar not null
+);
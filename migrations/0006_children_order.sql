@@ -0,0 +1,5 @@
+-- Дети папки постранично в порядке id; COLLATE "C" делает порядок независимым от локали базы
+create index if not exists disk_tree_parent_id_id_idx on disk_tree (parent_id, id collate "C");
+
+-- префикс (parent_id) покрывается новым индексом, в том числе для ON DELETE CASCADE
+drop index if exists disk_tree_parent_id_idx;
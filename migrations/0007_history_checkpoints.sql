@@ -0,0 +1,18 @@
+-- Контрольные точки истории: состояние каждого узла (последняя строка node_history не позже checkpoint_date).
+-- Срез дерева на момент T строится от ближайшей точки не позже T и доигрывает историю после нее.
+create table if not exists history_checkpoint (
+  checkpoint_date timestamptz not null,
+  id varchar not null,
+  parent_id varchar,
+  type varchar not null,
+  url varchar,
+  size integer,
+  date timestamptz not null,
+  -- Ключ служит и поиску состояния узла в точке, и очистке истории удаленного узла по id
+  primary key (id, checkpoint_date)
+);
+
+create index if not exists history_checkpoint_parent_id_idx on history_checkpoint (checkpoint_date, parent_id);
+
+-- Дети папки, появившиеся или переехавшие после контрольной точки
+create index if not exists node_history_parent_id_date_idx on node_history (parent_id, date);
@@ -0,0 +1,7 @@
+-- Поддеревья, удаленные DELETE, но еще не вычищенные из disk_tree. Короткая транзакция DELETE
+-- только пишет сюда корень поддерева: с этого момента чтения его не видят, а строки удаляются
+-- пачками в отдельных транзакциях. Незавершенные удаления дочищаются после перезапуска
+create table if not exists pending_deletes (
+  id varchar primary key,
+  full_route varchar not null
+);
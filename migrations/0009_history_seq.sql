@@ -0,0 +1,6 @@
+-- Строки истории одного узла с одной датой (повторный импорт с тем же updateDate) различает порядок записи:
+-- состояние на дату - последняя записанная строка, как и в хранилище в памяти
+create sequence if not exists node_history_seq;
+alter table node_history add column if not exists seq bigint not null default nextval('node_history_seq');
+drop index if exists node_history_id_date_idx;
+create index if not exists node_history_id_date_seq_idx on node_history (id, date, seq);
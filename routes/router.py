@@ -1,145 +1,241 @@
-from copy import copy
-from fastapi import APIRouter
+from fastapi import APIRouter, Query, Request, Response
+from fastapi.responses import StreamingResponse
 from fastapi.exceptions import RequestValidationError, HTTPException
-from datetime import datetime
-from core.nodes_repository import NodesRepository
-from core.helpers import update_parent
+from datetime import datetime, timedelta
+from core.engines import create_repository, is_memory_url, pool_options, postgres_dsn
+from core.cache import SubtreeCache
+from core.history_checkpointer import HistoryCheckpointer
+from core.history_purger import HistoryPurger
+from core.history_recorder import HistoryRecorder
+from core.helpers import (
+    add_delta, build_snapshot, build_tree, decode_cursor, decode_id_cursor, encode_cursor, encode_id_cursor,
+    is_not_modified, node_validators, update_parents,
+)
+from core.imports import import_items, import_stream
+from core.metrics import InstrumentedRepository, Metrics
+from core.node_events import NodeEvents
+from core.streaming import stream_items, stream_subtree
 import os
-import json
+from pydantic import ValidationError
 
 from models.models import (
-    SystemItem,
-    SystemItemHistoryResponse, SystemItemHistoryUnit,
-    SystemItemImportRequest, SystemItemType,
+    SystemItem, SystemItemHistoryResponse, SystemItemHistoryUnit,
+    SystemItemImport, SystemItemImportRequest, SystemItemType,
 )
 
 router = APIRouter()
 
 DATABASE_URL = os.environ['database_url']
-database = NodesRepository(DATABASE_URL)
+# Число процессов uvicorn; каждый воркер поднимает свой пул с одними и теми же настройками из окружения
+WORKERS = int(os.environ.get('workers', 1))
+if WORKERS > 1 and is_memory_url(DATABASE_URL):
+    raise RuntimeError("Memory storage can't be shared by several workers, use Postgres")
+metrics = Metrics()
+database = InstrumentedRepository(create_repository(DATABASE_URL, **pool_options(os.environ)), metrics)
+history_recorder = HistoryRecorder(database, max_queue_size=int(os.environ.get('history_queue_size', 10000)),
+                                   batch_size=int(os.environ.get('history_batch_size', 1000)),
+                                   max_attempts=int(os.environ.get('history_write_attempts', 10)))
+# Очередь отложенной истории своя у каждого воркера, и flush другого воркера ее не дождется:
+# с несколькими воркерами история пишется в транзакции изменения, как и без очереди
+if WORKERS == 1:
+    database.set_history_recorder(history_recorder)
+subtree_cache = SubtreeCache(int(os.environ.get('subtree_cache_bytes', 64 * 1024 * 1024)))
+node_events = NodeEvents(None if is_memory_url(DATABASE_URL) else postgres_dsn(DATABASE_URL), subtree_cache)
+IMPORT_CHUNK_SIZE = int(os.environ.get('import_chunk_size', 5000))
+IMPORT_MAX_PENDING_ITEMS = int(os.environ.get('import_max_pending_items', 100000))
+UPDATES_PAGE_SIZE = int(os.environ.get('updates_page_size', 1000))
+UPDATES_MAX_PAGE_SIZE = int(os.environ.get('updates_max_page_size', 10000))
+NODES_MAX_PAGE_SIZE = int(os.environ.get('nodes_max_page_size', 10000))
+DELETE_CHUNK_SIZE = int(os.environ.get('delete_chunk_size', 10000))
+PURGE_HISTORY_IN_BACKGROUND = os.environ.get('purge_history_in_background', '1') == '1'
+history_purger = HistoryPurger(database, chunk_size=DELETE_CHUNK_SIZE)
+# Интервал контрольных точек истории в секундах, 0 отключает их
+HISTORY_CHECKPOINT_INTERVAL = timedelta(seconds=int(os.environ.get('history_checkpoint_interval', 86400)))
+HISTORY_CHECKPOINT_KEEP = int(os.environ.get('history_checkpoint_keep', 30))
+history_checkpointer = HistoryCheckpointer(database, interval=HISTORY_CHECKPOINT_INTERVAL, keep=HISTORY_CHECKPOINT_KEEP)
+
+
+def parse_import_item(line) -> SystemItemImport:
+    try:
+        return SystemItemImport.model_validate_json(line)
+    except ValidationError as e:
+        raise RequestValidationError(str(e))
 
 
 @router.post('/imports')
 async def post_imports(body: SystemItemImportRequest):
-    request_ids = [item.id for item in body.items]
-    if len(set(request_ids)) != len(request_ids):
-        raise RequestValidationError("Can't have duplicate ids")
+    async with database.transaction():
+        changed_ids, moved_routes = await import_items(database, body.items, body.updateDate)
+        await database.notify_node_changes(node_events.notification(changed_ids, moved_routes))
+    subtree_cache.invalidate(changed_ids, moved_routes)
+
 
+@router.post('/imports/stream')
+async def post_imports_stream(request: Request, updateDate: datetime):
     """
-    Валидацию следует утащить в pydantic
+    Потоковый импорт: тело запроса в формате NDJSON, по одному SystemItemImport на строку.
+    Порядок строк произвольный, весь импорт выполняется в одной транзакции; строк, ждущих
+    своего родителя, может быть не больше import_max_pending_items.
     """
-    values_dict = {}
-    to_update = {}
-    for item in body.items:
-        if item.parentId == item.id:
-            raise RequestValidationError("Parent id can't be the same as id")
-        if item.type == SystemItemType.FOLDER and (item.url is not None or item.size is not None):
-            raise RequestValidationError("Folder can't have url or size")
-        elif item.type == SystemItemType.FILE and (item.url is None or item.size <= 0):
-            raise RequestValidationError("Item must have url and size")
-
-        full_route = f'/{item.id}'
-        if item.parentId:
-            if item.parentId in values_dict:
-                if values_dict[item.parentId]['type'] != SystemItemType.FOLDER.value:
-                    raise RequestValidationError("Parent must exist and be a folder")
-                full_route = values_dict[item.parentId]['full_route'] + full_route
-            else:
-                parent_node = await database.read_node({'id': item.parentId})
-                if not parent_node or parent_node.type != SystemItemType.FOLDER.value:
-                    raise RequestValidationError("Parent must exist and be a folder")
-                full_route = parent_node.full_route + full_route
-
-        existing_node = await database.read_node({'id': item.id})
-        if existing_node:
-            if existing_node.type != item.type.value:
-                raise RequestValidationError("Can't change type")
-            if existing_node.type == SystemItemType.FOLDER.value and existing_node.parent_id == item.parentId:
-                raise RequestValidationError("Nothing to update")
-            to_update[item.id] = existing_node
-
-        values_dict[item.id] = {"id": item.id, "parent_id": item.parentId, "type": item.type.value,
-                                "url": item.url, "date": body.updateDate, "size": item.size,
-                                "full_route": full_route}
-
-    for _, values in values_dict.items():
-        if values['id'] in to_update:
-            if values['type'] == SystemItemType.FOLDER.value:
-                update_folder_values = dict(to_update[values['id']]._mapping)
-                await update_parent(database, update_folder_values, adding=False)
-                update_folder_values['parent_id'] = values['parent_id']
-                await database.update_node(update_folder_values)
-                values['size'] = update_folder_values['size']
-            else:
-                await database.update_node(values_dict[values['id']])
-                if values['parent_id'] == to_update[values['id']].parent_id:
-                    values['size'] = values['size'] - to_update[values['id']].size
-                else:
-                    # Обновляем ветку, откуда был перенесен файл
-                    old_values = copy(values)
-                    old_values['parent_id'] = to_update[values['id']].parent_id
-                    await update_parent(database, old_values, adding=False)
-        else:
-            # if values['size'] is None:
-            #    values['size'] = 0
-            await database.create_node(values)
-        await update_parent(database, values)
+    try:
+        SystemItemImportRequest(items=[], updateDate=updateDate)
+    except ValidationError as e:
+        raise RequestValidationError(str(e))
+
+    async def items():
+        buffer = b''
+        async for data in request.stream():
+            buffer += data
+            *lines, buffer = buffer.split(b'\n')
+            for line in lines:
+                if line.strip():
+                    yield parse_import_item(line)
+        if buffer.strip():
+            yield parse_import_item(buffer)
+
+    async with database.transaction():
+        await import_stream(database, items(), updateDate, IMPORT_CHUNK_SIZE, IMPORT_MAX_PENDING_ITEMS)
+        await database.notify_node_changes(node_events.notification(clear=True))
+    subtree_cache.clear()
 
 
 @router.delete('/delete/{id}', response_model=None)
 async def delete_delete_id(id: str, date: datetime = ...) -> None:
-    node = await database.read_node({'id': id})
-    if node is None:
-        raise HTTPException(status_code=404, detail="Item not found")
-    if node.parent_id:
-        values_dict = dict(node._mapping)
-        values_dict['date'] = date
-        await update_parent(database, values_dict, adding=False)
-    await database.delete_node({"id": id})
+    async with database.transaction():
+        await database.lock_nodes({'ids': [id]})
+        node = await database.read_node({'id': id})
+        if node is None:
+            raise HTTPException(status_code=404, detail="Item not found")
+        deltas = {}
+        add_delta(deltas, node.parent_id, -(node.size if node.size else 0))
+        ancestors = await update_parents(database, deltas, date)
+        # Короткая транзакция только скрывает поддерево; строки удаляются пачками после ответа
+        await database.mark_deleted({'id': id, 'route': node.full_route})
+        await database.notify_node_changes(node_events.notification(ancestors + [id], [node.full_route]))
+    subtree_cache.invalidate(ancestors + [id], [node.full_route])
+    if PURGE_HISTORY_IN_BACKGROUND:
+        history_purger.schedule()
+    else:
+        await history_purger.purge()
 
 
 @router.get('/nodes/{id}')
-async def get_nodes_id(id: str):
+async def get_nodes_id(id: str, request: Request, stream: bool = False, depth: int = Query(None, ge=0),
+                       limit: int = Query(None, ge=1, le=NODES_MAX_PAGE_SIZE), cursor: str = None):
+    """
+    Без depth, limit и cursor отдается все поддерево, как в спецификации.
+    depth ограничивает глубину: папки на последнем уровне приходят с children = null.
+    limit ограничивает число прямых детей узла (по возрастанию id), продолжение списка запрашивается
+    с курсором из заголовка X-Next-Cursor. Вложенные папки приходят со всеми детьми, поэтому
+    вместе с limit обычно задается и depth.
+    """
+    paged = depth is not None or limit is not None or cursor is not None
+    cached = subtree_cache.get(id) if not stream and not paged else None
+    if cached is not None:
+        payload, validators = cached
+        if is_not_modified(request.headers, validators):
+            return Response(status_code=304, headers=validators)
+        return Response(content=payload, media_type='application/json', headers=validators)
+
+    generation = subtree_cache.begin()
     node = await database.read_node({'id': id})
     if node is None:
         raise HTTPException(status_code=404, detail="Item not found")
-    parent = SystemItem(id=node.id, type=node.type, url=node.url, size=node.size,
-                        date=node.date, parentId=node.parent_id, children=[])
-
-    """
-    Следует добавить поле в БД для хранения полного пути и, как следствие,
-    получения всех дочерних элементов через фильтрацию по подпути.
-    """
-    # children = await database.read_children_by_route({'route': node.full_route})
-    async def check_children(element) -> None:
-        children = await database.read_children({'id': element.id})
-        element.children = [SystemItem(id=child.id, type=child.type, url=child.url, size=child.size,
-                                       date=child.date, parentId=child.parent_id, children=[])
-                            for child in children]
-        for child in element.children:
-            await check_children(child)
-
-    await check_children(parent)
-
-    return parent
+    validators = node_validators(node)
+    if is_not_modified(request.headers, validators):
+        return Response(status_code=304, headers=validators)
+    if paged:
+        return await get_subtree_page(node, depth, limit, cursor, validators)
+    if stream:
+        return StreamingResponse(stream_subtree(database.iterate_subtree({'id': id})),
+                                 media_type='application/json', headers=validators)
+
+    children = await database.read_children_by_route({'id': node.id, 'route': node.full_route})
+    payload = build_tree(node, children).model_dump_json().encode()
+    subtree_cache.put(id, node.full_route, payload, generation, validators)
+    return Response(content=payload, media_type='application/json', headers=validators)
+
+
+async def get_subtree_page(node, depth, limit, cursor, validators) -> Response:
+    headers = dict(validators)
+    if node.type == SystemItemType.FOLDER.value and depth != 0:
+        rows = await database.read_subtree_page({'id': node.id, 'depth': depth, 'limit': limit,
+                                                 'after': decode_id_cursor(cursor) if cursor else None})
+        # Лишний прямой ребенок сверх limit только показывает, что есть следующая страница
+        if limit is not None and any(row.depth == 1 and row.position > limit for row in rows):
+            rows = [row for row in rows if row.depth > 1 or row.position <= limit]
+            last_child = next(row.id for row in rows if row.depth == 1 and row.position == limit)
+            headers['X-Next-Cursor'] = encode_id_cursor(last_child)
+    else:
+        rows = []
+    tree = build_tree(node, rows, depth)
+    return Response(content=tree.model_dump_json().encode(), media_type='application/json', headers=headers)
+
+
+@router.get('/cache/stats')
+async def get_cache_stats():
+    return subtree_cache.stats()
+
+
+@router.get('/metrics')
+async def get_metrics():
+    gauges = {f'subtree_cache_{name}': value for name, value in subtree_cache.stats().items()}
+    return Response(content=metrics.render(gauges), media_type='text/plain; version=0.0.4')
 
 
 @router.get('/node/{id}/history', response_model=SystemItemHistoryResponse)
-async def get_node_id_history(id:str, date_start: datetime, date_end: datetime) -> SystemItemHistoryResponse:
+async def get_node_id_history(id:str, date_start: datetime, date_end: datetime,
+                              stream: bool = False) -> SystemItemHistoryResponse:
     node = await database.read_node({'id': id})
     if node is None:
         raise HTTPException(status_code=404, detail="Item not found")
     query_values = {'id': id, 'date_start': date_start, 'date_end': date_end}
+    await database.flush_history()
+    if stream:
+        return StreamingResponse(stream_items(database.iterate_history_per_node(query_values)),
+                                 media_type='application/json')
     nodes = await database.get_history_per_node(query_values)
-    nodes_dicts = [json.loads(dict(node._mapping)['content']) for node in nodes]
-    items = [SystemItemHistoryUnit(id=node['id'], type=node['type'], url=node['url'], size=node['size'],
-                                   date=node['date'], parentId=node['parent_id']) for node in nodes_dicts]
+    items = [SystemItemHistoryUnit(id=node.id, type=node.type, url=node.url, size=node.size,
+                                   date=node.date, parentId=node.parent_id) for node in nodes]
     return SystemItemHistoryResponse(items=items)
 
 
+@router.get('/node/{id}/snapshot', response_model=SystemItem)
+async def get_node_id_snapshot(id: str, date: datetime) -> SystemItem:
+    """
+    Поддерево узла в том виде, в каком оно было на момент date: от ближайшей контрольной точки
+    доигрывается история после нее. Удаленных узлов в срезах нет, даже пока их история не очищена.
+    """
+    node = await database.read_node({'id': id})
+    if node is None:
+        raise HTTPException(status_code=404, detail="Item not found")
+    await database.flush_history()
+    rows = await database.read_subtree_at({'id': id, 'date': date})
+    if not rows:
+        raise HTTPException(status_code=404, detail="Item not found")
+    return build_snapshot(id, rows)
+
+
 @router.get('/updates', response_model=SystemItemHistoryResponse)
-async def get_updates(date: datetime) -> SystemItemHistoryResponse:
-    nodes = await database.updates_till_date({'date': date})
+async def get_updates(date: datetime, response: Response, stream: bool = False,
+                      limit: int = Query(None, ge=1, le=UPDATES_MAX_PAGE_SIZE), cursor: str = None,
+                      item_type: SystemItemType = Query(None, alias='type')) -> SystemItemHistoryResponse:
+    """
+    Узлы, обновленные за [date - 24h, date], по порядку (date, id), не больше limit за запрос.
+    Если есть продолжение, его курсор отдается в заголовке X-Next-Cursor.
+    Потоковый режим отдает весь остаток окна от курсора, если limit не задан явно.
+    """
+    query_values = {'date': date, 'after': decode_cursor(cursor) if cursor else None,
+                    'type': item_type.value if item_type else None}
+    if stream:
+        return StreamingResponse(stream_items(database.iterate_updates(dict(query_values, limit=limit))),
+                                 media_type='application/json')
+    limit = limit or UPDATES_PAGE_SIZE
+    # Лишняя строка показывает, есть ли следующая страница
+    nodes = await database.updates_till_date(dict(query_values, limit=limit + 1))
+    if len(nodes) > limit:
+        nodes = nodes[:limit]
+        response.headers['X-Next-Cursor'] = encode_cursor(nodes[-1].date, nodes[-1].id)
     items = [SystemItemHistoryUnit(id=node.id, type=node.type, url=node.url, size=node.size,
                                    date=node.date, parentId=node.parent_id) for node in nodes]
     return SystemItemHistoryResponse(items=items)
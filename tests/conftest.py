@@ -0,0 +1,95 @@
+import os
+import sys
+from pathlib import Path
+
+# Настройки читаются при импорте routes.router, поэтому задаются до него
+os.environ.setdefault('database_url', 'memory://')
+os.environ.setdefault('log_file', os.devnull)
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import asyncpg
+import httpx
+import pytest
+
+import routes.router as router
+from core.cache import SubtreeCache
+from core.engines import create_repository, is_memory_url, postgres_dsn
+from core.history_checkpointer import HistoryCheckpointer
+from core.history_purger import HistoryPurger
+from core.history_recorder import HistoryRecorder
+from core.metrics import InstrumentedRepository
+from core.migrations import apply_migrations
+from core.node_events import NodeEvents
+from main import app
+
+# Postgres для тестов, например postgresql://postgres@localhost:5433/yd_test; без него проверяется только память.
+# Тесты очищают таблицы базы, поэтому рабочую базу указывать нельзя
+TEST_DATABASE_URL = os.environ.get('test_database_url')
+TABLES = ('disk_tree', 'node_history', 'node_tombstones', 'history_checkpoint', 'pending_deletes')
+
+
+def engine_urls() -> dict:
+    urls = {'memory': 'memory://'}
+    if TEST_DATABASE_URL:
+        dsn = postgres_dsn(TEST_DATABASE_URL)
+        urls['databases'] = dsn
+        urls['asyncpg'] = 'postgresql+asyncpg://' + dsn[len('postgresql://'):]
+    return urls
+
+
+@pytest.fixture
+def anyio_backend():
+    return 'asyncio'
+
+
+@pytest.fixture(params=list(engine_urls().items()), ids=lambda item: item[0])
+def database_url(request):
+    return request.param[1]
+
+
+async def reset_postgres(connection_string) -> None:
+    await apply_migrations(connection_string)
+    connection = await asyncpg.connect(connection_string)
+    try:
+        await connection.execute(f"TRUNCATE {', '.join(TABLES)}")
+    finally:
+        await connection.close()
+
+
+@pytest.fixture
+async def engine(database_url, monkeypatch):
+    """Свежий движок вместо модульных объектов routes.router, запущенный как при старте приложения"""
+
+    if not is_memory_url(database_url):
+        await reset_postgres(postgres_dsn(database_url))
+    database = InstrumentedRepository(create_repository(database_url), router.metrics)
+    recorder = HistoryRecorder(database)
+    database.set_history_recorder(recorder)
+    cache = SubtreeCache(router.subtree_cache.stats()['max_bytes'])
+    services = {
+        'database': database,
+        'history_recorder': recorder,
+        'history_purger': HistoryPurger(database, chunk_size=router.DELETE_CHUNK_SIZE),
+        'history_checkpointer': HistoryCheckpointer(database, interval=router.HISTORY_CHECKPOINT_INTERVAL,
+                                                    keep=router.HISTORY_CHECKPOINT_KEEP),
+        'subtree_cache': cache,
+        'node_events': NodeEvents(None, cache),
+    }
+    for name, value in services.items():
+        monkeypatch.setattr(router, name, value)
+    await database.connect()
+    recorder.start()
+    services['history_purger'].start()
+    try:
+        yield services
+    finally:
+        await services['history_purger'].stop()
+        await recorder.stop()
+        await database.disconnect()
+
+
+@pytest.fixture
+async def client(engine):
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://test') as client:
+        yield client
@@ -0,0 +1,375 @@
+import json
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import routes.router as router
+from core.history_checkpointer import CHECKPOINT_DELAY, HistoryCheckpointer
+
+pytestmark = pytest.mark.anyio
+
+DATE = '2030-05-28T21:12:01Z'
+LATER = '2030-05-29T21:12:01Z'
+
+
+def folder(id, parent_id=None):
+    return {'id': id, 'type': 'FOLDER', 'parentId': parent_id, 'url': None, 'size': None}
+
+
+def file(id, parent_id, size):
+    return {'id': id, 'type': 'FILE', 'parentId': parent_id, 'url': f'/file/{id}', 'size': size}
+
+
+def normalized(tree) -> dict:
+    children = tree['children']
+    if children is not None:
+        children = sorted((normalized(child) for child in children), key=lambda child: child['id'])
+    return dict(tree, children=children)
+
+
+async def post_imports(client, items, date=DATE):
+    response = await client.post('/imports', json={'items': items, 'updateDate': date})
+    assert response.status_code == 200, response.text
+
+
+async def test_import_builds_tree_with_folder_sizes(client):
+    await post_imports(client, [folder('root'), folder('a', 'root'), file('a1', 'a', 10), file('r1', 'root', 5)])
+
+    response = await client.get('/nodes/root')
+
+    assert response.status_code == 200
+    tree = response.json()
+    assert tree['size'] == 15
+    assert tree['date'] == '2030-05-28T21:12:01Z'
+    children = {child['id']: child for child in tree['children']}
+    assert children['a']['size'] == 10
+    assert children['a']['children'][0]['id'] == 'a1'
+    assert children['r1']['children'] is None
+
+
+async def test_update_moves_size_between_folders(client):
+    await post_imports(client, [folder('root'), folder('a', 'root'), folder('b', 'root'), file('f', 'a', 10)])
+    await post_imports(client, [file('f', 'b', 12)], LATER)
+
+    tree = (await client.get('/nodes/root')).json()
+
+    sizes = {child['id']: child['size'] for child in tree['children']}
+    assert tree['size'] == 12
+    assert sizes == {'a': 0, 'b': 12}
+
+
+async def test_delete_removes_subtree_and_updates_ancestors(client):
+    await post_imports(client, [folder('root'), folder('a', 'root'), file('a1', 'a', 10), file('r1', 'root', 5)])
+
+    response = await client.delete('/delete/a', params={'date': LATER})
+
+    assert response.status_code == 200
+    assert (await client.get('/nodes/a')).status_code == 404
+    assert (await client.get('/nodes/a1')).status_code == 404
+    tree = (await client.get('/nodes/root')).json()
+    assert tree['size'] == 5
+    assert tree['date'] == '2030-05-29T21:12:01Z'
+
+
+async def test_delete_unknown_node_returns_404(client):
+    response = await client.delete('/delete/missing', params={'date': DATE})
+
+    assert response.status_code == 404
+
+
+async def test_invalid_import_is_rejected(client):
+    response = await client.post('/imports', json={'items': [file('f', None, -1)], 'updateDate': DATE})
+
+    assert response.status_code == 400
+    assert (await client.get('/nodes/f')).status_code == 404
+
+
+async def test_history_of_file(client):
+    await post_imports(client, [folder('root'), file('f', 'root', 10)])
+    await post_imports(client, [file('f', 'root', 20)], LATER)
+
+    response = await client.get('/node/f/history', params={'date_start': DATE, 'date_end': LATER})
+
+    assert response.status_code == 200
+    assert [item['size'] for item in response.json()['items']] == [10, 20]
+
+
+async def test_updates_window(client):
+    await post_imports(client, [folder('root'), file('old', 'root', 1)], '2030-05-20T00:00:00Z')
+    await post_imports(client, [file('new', 'root', 2)])
+
+    response = await client.get('/updates', params={'date': DATE})
+
+    assert response.status_code == 200
+    assert {item['id'] for item in response.json()['items']} == {'root', 'new'}
+
+
+async def test_failed_import_leaves_no_trace(client, engine):
+    await post_imports(client, [folder('root'), file('f', 'root', 10)])
+
+    # Папка не может стать ребенком файла: весь импорт откатывается
+    response = await client.post('/imports', json={'items': [folder('x', 'root'), file('g', 'f', 1)],
+                                                   'updateDate': LATER})
+
+    assert response.status_code == 400
+    assert (await client.get('/nodes/x')).status_code == 404
+    assert (await client.get('/nodes/root')).json()['size'] == 10
+
+
+async def test_late_history_of_deleted_node_is_not_written(client, engine):
+    await post_imports(client, [folder('root'), file('f', 'root', 10)])
+    await client.delete('/delete/f', params={'date': LATER})
+    await engine['history_purger'].purge()
+    database = engine['database']
+
+    # Строка из очереди, дошедшая до базы уже после удаления узла и очистки его истории
+    late_row = {'id': 'f', 'parent_id': 'root', 'type': 'FILE', 'url': '/file/f', 'size': 10,
+                'date': datetime(2030, 5, 28, 21, 12, 1, tzinfo=timezone.utc)}
+    await database.write_history({'nodes': [late_row]})
+
+    rows = await database.get_history_per_node({'id': 'f', 'date_start': late_row['date'],
+                                                'date_end': late_row['date']})
+    assert rows == []
+
+
+async def test_folder_in_batch_and_among_ancestors_has_one_history_row(client):
+    await post_imports(client, [folder('root'), folder('a', 'root'), file('f', 'a', 10)])
+
+    response = await client.get('/node/a/history', params={'date_start': DATE, 'date_end': DATE})
+
+    assert [(item['size'], item['date']) for item in response.json()['items']] == [(10, DATE)]
+
+
+async def test_stream_import_writes_one_history_row_per_node(client, monkeypatch):
+    monkeypatch.setattr(router, 'IMPORT_CHUNK_SIZE', 1)
+    lines = [folder('root'), file('f1', 'root', 1), file('f2', 'root', 2), file('f3', 'root', 3)]
+    body = '\n'.join(json.dumps(line) for line in lines)
+
+    response = await client.post('/imports/stream', params={'updateDate': DATE}, content=body)
+
+    assert response.status_code == 200, response.text
+    history = await client.get('/node/root/history', params={'date_start': DATE, 'date_end': DATE})
+    assert [item['size'] for item in history.json()['items']] == [6]
+
+
+async def test_stream_import_rejects_duplicates_across_chunks(client, monkeypatch):
+    monkeypatch.setattr(router, 'IMPORT_CHUNK_SIZE', 2)
+    lines = [folder('root'), file('f1', 'root', 1), file('f2', 'root', 2), file('f1', 'root', 3)]
+    body = '\n'.join(json.dumps(line) for line in lines)
+
+    response = await client.post('/imports/stream', params={'updateDate': DATE}, content=body)
+
+    assert response.status_code == 400
+    assert (await client.get('/nodes/root')).status_code == 404
+
+
+async def test_stream_import_limits_items_waiting_for_parent(client, monkeypatch):
+    monkeypatch.setattr(router, 'IMPORT_CHUNK_SIZE', 1)
+    monkeypatch.setattr(router, 'IMPORT_MAX_PENDING_ITEMS', 2)
+    lines = [file(f'f{index}', 'root', 1) for index in range(3)] + [folder('root')]
+    body = '\n'.join(json.dumps(line) for line in lines)
+
+    response = await client.post('/imports/stream', params={'updateDate': DATE}, content=body)
+
+    assert response.status_code == 400
+    assert (await client.get('/nodes/root')).status_code == 404
+
+    monkeypatch.setattr(router, 'IMPORT_MAX_PENDING_ITEMS', 3)
+    response = await client.post('/imports/stream', params={'updateDate': DATE}, content=body)
+    assert response.status_code == 200, response.text
+    assert (await client.get('/nodes/root')).json()['size'] == 3
+
+
+async def test_deleted_subtree_is_hidden_until_background_delete(client, engine):
+    await engine['history_purger'].stop()
+    await post_imports(client, [folder('root'), folder('a', 'root'), folder('b', 'a'), file('b1', 'b', 3),
+                                file('a1', 'a', 10), folder('c', 'root')])
+
+    assert (await client.delete('/delete/a', params={'date': LATER})).status_code == 200
+
+    for node_id in ('a', 'b', 'b1'):
+        assert (await client.get(f'/nodes/{node_id}')).status_code == 404
+    tree = (await client.get('/nodes/root')).json()
+    assert tree['size'] == 0
+    assert [child['id'] for child in tree['children']] == ['c']
+    updates = (await client.get('/updates', params={'date': LATER})).json()['items']
+    assert {item['id'] for item in updates} == {'root', 'c'}
+    response = await client.post('/imports', json={'items': [file('x', 'b', 1)], 'updateDate': LATER})
+    assert response.status_code == 400
+
+    # Узел из удаляемого поддерева можно сразу импортировать заново в другое место
+    await post_imports(client, [file('a1', 'c', 4)], LATER)
+    assert (await client.get('/nodes/a1')).json()['parentId'] == 'c'
+
+    await engine['history_purger'].purge()
+    assert (await client.get('/nodes/root')).json()['size'] == 4
+    history = await client.get('/node/a1/history', params={'date_start': DATE, 'date_end': LATER})
+    assert history.json()['items'][-1]['parentId'] == 'c'
+
+
+async def test_limit_pages_only_direct_children(client):
+    await post_imports(client, [folder('root'), folder('a', 'root'), file('b', 'root', 1), file('c', 'root', 2),
+                                file('a1', 'a', 3), file('a2', 'a', 4), file('a3', 'a', 5)])
+
+    response = await client.get('/nodes/root', params={'limit': 2})
+
+    tree = response.json()
+    assert [child['id'] for child in tree['children']] == ['a', 'b']
+    assert [child['id'] for child in tree['children'][0]['children']] == ['a1', 'a2', 'a3']
+    cursor = response.headers['X-Next-Cursor']
+    response = await client.get('/nodes/root', params={'limit': 2, 'cursor': cursor})
+    assert [child['id'] for child in response.json()['children']] == ['c']
+    assert 'X-Next-Cursor' not in response.headers
+
+    tree = (await client.get('/nodes/root', params={'depth': 1})).json()
+    assert {child['id']: child['children'] for child in tree['children']} == {'a': None, 'b': None, 'c': None}
+
+
+@pytest.mark.parametrize('with_checkpoints', [False, True], ids=['replay', 'checkpoints'])
+async def test_snapshots_match_live_tree(client, engine, with_checkpoints):
+    steps = [
+        ('2030-05-01T00:00:00Z', [folder('root'), folder('a', 'root'), folder('b', 'root'), folder('empty', 'root'),
+                                  file('f1', 'a', 10), file('f2', 'a', 20)]),
+        ('2030-05-02T00:00:00Z', [file('f1', 'b', 15), folder('c', 'a'), file('f3', 'c', 5)]),
+        ('2030-05-03T00:00:00Z', [folder('c', 'b'), file('f2', 'a', 1)]),
+        ('2030-05-04T00:00:00Z', [file('f4', 'empty', 7)]),
+        # Опустевшая папка в срезе, как и в живом дереве, имеет размер 0, а не null
+        ('2030-05-05T00:00:00Z', [file('f2', 'b', 1)]),
+    ]
+    checkpointer = HistoryCheckpointer(engine['database'], interval=timedelta(days=1), keep=1)
+    live = {}
+    for index, (date, items) in enumerate(steps):
+        await post_imports(client, items, date)
+        live[date] = normalized((await client.get('/nodes/root')).json())
+        if with_checkpoints and index % 2 == 0:
+            # Точка ровно на дате шага; с keep=1 вторая точка вытесняет первую
+            assert await checkpointer.checkpoint(now=datetime.fromisoformat(date) + CHECKPOINT_DELAY) > 0
+
+    assert {child['id']: child['size'] for child in live[steps[-1][0]]['children']}['a'] == 0
+    for date, tree in live.items():
+        response = await client.get('/node/root/snapshot', params={'date': date})
+        assert response.status_code == 200, response.text
+        assert normalized(response.json()) == tree, date
+
+
+@pytest.mark.parametrize('with_checkpoints', [False, True], ids=['replay', 'checkpoints'])
+async def test_snapshot_of_reimport_with_same_date_takes_last_write(client, engine, with_checkpoints):
+    await post_imports(client, [folder('root'), file('f', 'root', 10)])
+    await post_imports(client, [file('f', 'root', 20)])
+    if with_checkpoints:
+        checkpointer = HistoryCheckpointer(engine['database'], interval=timedelta(days=1), keep=1)
+        # Точка в полночь после DATE: срез на LATER читает f из нее
+        assert await checkpointer.checkpoint(now=datetime.fromisoformat(LATER) + CHECKPOINT_DELAY) > 0
+
+    live = normalized((await client.get('/nodes/root')).json())
+    response = await client.get('/node/root/snapshot', params={'date': LATER})
+
+    assert live['size'] == 20
+    assert normalized(response.json()) == live
+
+
+async def test_snapshot_skips_deleted_subtree_before_purge(client, engine):
+    await engine['history_purger'].stop()
+    await post_imports(client, [folder('root'), folder('a', 'root'), file('a1', 'a', 10), folder('c', 'root')])
+
+    assert (await client.delete('/delete/a', params={'date': LATER})).status_code == 200
+
+    tree = (await client.get('/node/root/snapshot', params={'date': LATER})).json()
+    assert tree['size'] == 0
+    assert [child['id'] for child in tree['children']] == ['c']
+    for node_id in ('a', 'a1'):
+        response = await client.get(f'/node/{node_id}/snapshot', params={'date': DATE})
+        assert response.status_code == 404
+
+
+async def test_ancestors_get_history_rows_with_new_sizes(client):
+    await post_imports(client, [folder('root'), folder('a', 'root'), file('f', 'a', 10)])
+    await post_imports(client, [file('g', 'a', 5)], LATER)
+
+    for node_id, sizes in (('root', [10, 15]), ('a', [10, 15])):
+        response = await client.get(f'/node/{node_id}/history', params={'date_start': DATE, 'date_end': LATER})
+        assert [(item['size'], item['date']) for item in response.json()['items']] == list(zip(sizes, [DATE, LATER]))
+
+
+async def test_updates_keyset_pages_cover_window_once(client):
+    await post_imports(client, [folder('root')] + [file(f'f{index:02}', 'root', index + 1) for index in range(7)])
+
+    pages, cursor = [], None
+    while True:
+        params = {'date': DATE, 'limit': 3, 'type': 'FILE'}
+        if cursor:
+            params['cursor'] = cursor
+        response = await client.get('/updates', params=params)
+        assert response.status_code == 200, response.text
+        pages.append([item['id'] for item in response.json()['items']])
+        cursor = response.headers.get('X-Next-Cursor')
+        if cursor is None:
+            break
+
+    assert pages == [['f00', 'f01', 'f02'], ['f03', 'f04', 'f05'], ['f06']]
+
+
+async def test_streaming_responses_match_regular_ones(client):
+    await post_imports(client, [folder('root'), folder('a', 'root'), file('a1', 'a', 10), file('r1', 'root', 5)])
+    await post_imports(client, [file('a1', 'root', 12)], LATER)
+
+    requests = [('/nodes/root', {}), ('/updates', {'date': LATER}),
+                ('/node/a1/history', {'date_start': DATE, 'date_end': LATER})]
+    for path, params in requests:
+        regular = await client.get(path, params=params)
+        streamed = await client.get(path, params=dict(params, stream='true'))
+        assert streamed.status_code == 200, path
+        if path.startswith('/nodes'):
+            assert normalized(streamed.json()) == normalized(regular.json())
+        else:
+            assert streamed.json() == regular.json(), path
+
+
+async def test_stream_import_in_any_order_matches_batch_import(client):
+    lines = [file('a1', 'a', 10), folder('a', 'root'), file('r1', 'root', 5), folder('root')]
+    body = '\n'.join(json.dumps(line) for line in lines) + '\n'
+
+    response = await client.post('/imports/stream', params={'updateDate': DATE}, content=body)
+
+    assert response.status_code == 200, response.text
+    tree = normalized((await client.get('/nodes/root')).json())
+    assert tree['size'] == 15
+    assert [(child['id'], child['size']) for child in tree['children']] == [('a', 10), ('r1', 5)]
+
+
+
+async def test_conditional_get_of_subtree(client):
+    await post_imports(client, [folder('root'), file('f', 'root', 10)])
+    etag = (await client.get('/nodes/root')).headers['ETag']
+
+    assert (await client.get('/nodes/root', headers={'If-None-Match': etag})).status_code == 304
+
+    await post_imports(client, [file('g', 'root', 1)], LATER)
+    response = await client.get('/nodes/root', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.json()['size'] == 11
+
+
+async def test_changes_within_one_second_are_not_304(client):
+    await post_imports(client, [folder('root'), file('f', 'root', 10)], '2030-05-28T21:12:01.100Z')
+    validators = (await client.get('/nodes/root')).headers
+    await post_imports(client, [file('g', 'root', 1)], '2030-05-28T21:12:01.900Z')
+
+    # Last-Modified у обеих версий одинаковый: в нем нет долей секунды
+    for header, value in (('If-Modified-Since', validators['Last-Modified']), ('If-None-Match', validators['ETag'])):
+        response = await client.get('/nodes/root', headers={header: value})
+        assert response.status_code == 200, header
+        assert response.json()['size'] == 11
+
+
+async def test_delete_with_earlier_date_is_not_304(client):
+    await post_imports(client, [folder('root'), file('f', 'root', 10), file('g', 'root', 1)], LATER)
+    validators = (await client.get('/nodes/root')).headers
+
+    # date папки уходит назад, а размер меняется
+    assert (await client.delete('/delete/g', params={'date': DATE})).status_code == 200
+
+    for header, value in (('If-Modified-Since', validators['Last-Modified']), ('If-None-Match', validators['ETag'])):
+        response = await client.get('/nodes/root', headers={header: value})
+        assert response.status_code == 200, header
+        assert response.json()['size'] == 10
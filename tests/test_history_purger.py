@@ -0,0 +1,48 @@
+import asyncio
+
+import pytest
+
+from core.history_purger import HistoryPurger
+
+pytestmark = pytest.mark.anyio
+
+
+class FakeDatabase:
+    def __init__(self):
+        self.chunk_started = asyncio.Event()
+        self.release_chunk = asyncio.Event()
+        self.finished_chunks = 0
+
+    async def read_pending_deletes(self):
+        return ['a']
+
+    async def delete_pending_chunk(self, query_values):
+        self.chunk_started.set()
+        await self.release_chunk.wait()
+        self.finished_chunks += 1
+        return {'deleted': query_values['chunk_size'], 'last_route': f'/a/{self.finished_chunks}'}
+
+    async def delete_node(self, query_values):
+        return 1
+
+    async def flush_history(self):
+        pass
+
+    async def purge_history(self, query_values):
+        return 0
+
+
+async def test_stop_waits_for_current_chunk_instead_of_cancelling_it():
+    database = FakeDatabase()
+    purger = HistoryPurger(database, chunk_size=10)
+    purger.start()
+    await asyncio.wait_for(database.chunk_started.wait(), timeout=5)
+
+    stopping = asyncio.create_task(purger.stop())
+    await asyncio.sleep(0.01)
+    assert not stopping.done()
+
+    database.release_chunk.set()
+    await asyncio.wait_for(stopping, timeout=5)
+    # Начатая пачка дошла до конца, следующая уже не начиналась
+    assert database.finished_chunks == 1
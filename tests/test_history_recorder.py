@@ -0,0 +1,86 @@
+import asyncio
+
+import pytest
+
+from core.history_recorder import HistoryRecorder
+
+pytestmark = pytest.mark.anyio
+
+
+class FakeDatabase:
+    def __init__(self, failures=0, delay=0.0, bad_ids=()):
+        self.rows = []
+        self.failures = failures
+        self.delay = delay
+        self.bad_ids = set(bad_ids)
+
+    async def write_history(self, query_values):
+        await asyncio.sleep(self.delay)
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError('database is down')
+        if any(row['id'] in self.bad_ids for row in query_values['nodes']):
+            raise ValueError('bad row')
+        self.rows.extend(query_values['nodes'])
+
+
+async def test_unstarted_recorder_writes_synchronously():
+    database = FakeDatabase()
+    recorder = HistoryRecorder(database, max_queue_size=1)
+
+    await recorder.record([{'id': 'a'}, {'id': 'b'}])
+    await recorder.flush()
+
+    assert database.rows == [{'id': 'a'}, {'id': 'b'}]
+
+
+async def test_flush_waits_only_for_rows_recorded_before_it():
+    database = FakeDatabase(delay=0.01)
+    recorder = HistoryRecorder(database, max_queue_size=10, batch_size=5, flush_interval=0.001)
+    recorder.start()
+    stop = asyncio.Event()
+
+    async def sustained_writes():
+        index = 0
+        while not stop.is_set():
+            await recorder.record([{'id': index}])
+            index += 1
+
+    producer = asyncio.create_task(sustained_writes())
+    await recorder.record([{'id': 'marker'}])
+    await asyncio.wait_for(recorder.flush(), timeout=5)
+
+    assert {'id': 'marker'} in database.rows
+    stop.set()
+    await producer
+    await recorder.stop()
+
+
+async def test_failed_batches_are_retried_not_dropped():
+    database = FakeDatabase(failures=3)
+    recorder = HistoryRecorder(database, flush_interval=0.001)
+    recorder.start()
+
+    await recorder.record([{'id': 'a'}])
+    await asyncio.wait_for(recorder.flush(), timeout=5)
+
+    assert database.rows == [{'id': 'a'}]
+    await recorder.stop()
+
+
+async def test_batch_that_always_fails_does_not_block_flush(caplog):
+    database = FakeDatabase(bad_ids={'bad'})
+    recorder = HistoryRecorder(database, batch_size=10, flush_interval=0.001, max_attempts=3)
+    recorder.start()
+
+    await recorder.record([{'id': 'a'}, {'id': 'bad'}, {'id': 'b'}])
+    await asyncio.wait_for(recorder.flush(), timeout=5)
+
+    # Хорошие строки пачки записаны по одной, плохая ушла в лог недописанных строк
+    assert database.rows == [{'id': 'a'}, {'id': 'b'}]
+    dropped = [record for record in caplog.records if record.name == 'history.dead_letter']
+    assert len(dropped) == 1 and '"bad"' in dropped[0].getMessage()
+
+    await recorder.record([{'id': 'c'}])
+    await asyncio.wait_for(recorder.stop(), timeout=5)
+    assert database.rows[-1] == {'id': 'c'}
@@ -0,0 +1,60 @@
+import asyncio
+
+import pytest
+
+from core.engines import is_memory_url
+
+pytestmark = pytest.mark.anyio
+
+DATE = '2030-05-28T21:12:01Z'
+
+
+@pytest.fixture
+async def tree(database_url, client):
+    # В памяти транзакции и так выполняются по одной, проверять нечего
+    if is_memory_url(database_url):
+        pytest.skip('memory transactions are serialized')
+    items = [{'id': 'root', 'type': 'FOLDER', 'parentId': None, 'url': None, 'size': None},
+             {'id': 'a', 'type': 'FOLDER', 'parentId': 'root', 'url': None, 'size': None},
+             {'id': 'b', 'type': 'FOLDER', 'parentId': 'root', 'url': None, 'size': None}]
+    response = await client.post('/imports', json={'items': items, 'updateDate': DATE})
+    assert response.status_code == 200, response.text
+
+
+async def hold_locks(database, query_values, locked, release):
+    async with database.transaction():
+        await database.lock_nodes(query_values)
+        locked.set()
+        await release.wait()
+
+
+async def lock_while_held(database, held, wanted, timeout=1.0) -> bool:
+    """Успевает ли вторая транзакция взять блокировки, пока первая держит свои"""
+
+    locked, release = asyncio.Event(), asyncio.Event()
+    holder = asyncio.create_task(hold_locks(database, held, locked, release))
+    await locked.wait()
+    released = asyncio.Event()
+    released.set()
+    try:
+        await asyncio.wait_for(hold_locks(database, wanted, asyncio.Event(), released), timeout)
+        return True
+    except asyncio.TimeoutError:
+        return False
+    finally:
+        release.set()
+        await holder
+
+
+async def test_imports_into_sibling_folders_do_not_wait(tree, engine):
+    database = engine['database']
+
+    assert await lock_while_held(database, {'ids': ['a1'], 'parent_ids': ['a']},
+                                 {'ids': ['b1'], 'parent_ids': ['b']})
+
+
+async def test_moving_folder_waits_for_import_below_it(tree, engine):
+    database = engine['database']
+
+    assert not await lock_while_held(database, {'ids': ['a1'], 'parent_ids': ['a']},
+                                     {'ids': ['a'], 'parent_ids': ['b']}, timeout=0.5)
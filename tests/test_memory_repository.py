@@ -0,0 +1,83 @@
+import asyncio
+from datetime import datetime, timezone
+
+import pytest
+
+from core.memory_repository import MemoryRepository
+
+pytestmark = pytest.mark.anyio
+
+DATE = datetime(2030, 5, 28, 21, 12, 1, tzinfo=timezone.utc)
+
+
+def node(id, parent_id=None, type='FOLDER', size=None):
+    return {'id': id, 'url': None, 'type': type, 'size': size, 'date': DATE,
+            'full_route': f'/{id}' if parent_id is None else f'/{parent_id}/{id}', 'parent_id': parent_id}
+
+
+async def test_reads_do_not_see_uncommitted_changes():
+    repository = MemoryRepository()
+    await repository.upsert_nodes({'nodes': [node('root')]})
+    started, release = asyncio.Event(), asyncio.Event()
+
+    async def failing_import():
+        async with repository.transaction():
+            await repository.upsert_nodes({'nodes': [node('a', 'root')]})
+            await repository.update_ancestors({'deltas': {'root': 10}, 'date': DATE})
+            started.set()
+            await release.wait()
+            raise RuntimeError('rollback')
+
+    task = asyncio.create_task(failing_import())
+    await started.wait()
+    read = asyncio.create_task(repository.read_node({'id': 'a'}))
+    await asyncio.sleep(0)
+    assert not read.done()
+
+    release.set()
+    with pytest.raises(RuntimeError):
+        await task
+    assert await read is None
+    assert (await repository.read_node({'id': 'root'})).size is None
+
+
+async def test_reads_inside_transaction_see_own_changes():
+    repository = MemoryRepository()
+    async with repository.transaction():
+        await repository.upsert_nodes({'nodes': [node('root')]})
+        assert (await repository.read_node({'id': 'root'})).id == 'root'
+
+
+async def test_state_survives_restart(tmp_path):
+    path = str(tmp_path / 'tree.jsonl')
+    repository = MemoryRepository(path)
+    await repository.connect()
+    async with repository.transaction():
+        await repository.upsert_nodes({'nodes': [node('root'), node('f', 'root', 'FILE', 7)]})
+        await repository.update_ancestors({'deltas': {'root': 7}, 'date': DATE})
+    await repository.disconnect()
+
+    restored = MemoryRepository(path)
+    await restored.connect()
+
+    assert (await restored.read_node({'id': 'root'})).size == 7
+    history = await restored.get_history_per_node({'id': 'f', 'date_start': DATE, 'date_end': DATE})
+    assert [row.size for row in history] == [7]
+    await restored.disconnect()
+
+
+async def test_snapshot_after_restart_uses_loaded_history(tmp_path):
+    path = str(tmp_path / 'tree.jsonl')
+    repository = MemoryRepository(path)
+    await repository.connect()
+    async with repository.transaction():
+        await repository.upsert_nodes({'nodes': [node('root'), node('f', 'root', 'FILE', 7)]})
+    await repository.disconnect()
+
+    restored = MemoryRepository(path)
+    await restored.connect()
+
+    assert await restored.create_history_checkpoint({'date': DATE, 'keep': 1}) == 2
+    rows = await restored.read_subtree_at({'id': 'root', 'date': DATE})
+    assert sorted(row.id for row in rows) == ['f', 'root']
+    await restored.disconnect()
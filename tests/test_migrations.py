@@ -0,0 +1,15 @@
+import pytest
+
+from core.engines import is_memory_url, postgres_dsn
+from core.migrations import apply_migrations, check_query_plans
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_hot_queries_use_indexes(database_url):
+    if is_memory_url(database_url):
+        pytest.skip('memory storage has no query plans')
+    connection_string = postgres_dsn(database_url)
+    await apply_migrations(connection_string)
+
+    assert await check_query_plans(connection_string) == {}